@@ -0,0 +1,142 @@
+import os
+
+from sql.database import DB_MAX_OVERFLOW, DB_POOL_SIZE
+
+
+def _int_env(name, default):
+    return int(os.getenv(name, default))
+
+
+def parse_keys(value):
+    # "kid:secret,kid:secret"; the first entry signs new tokens. A single
+    # value without a colon is taken as the secret of a key named "default".
+    value = value.strip()
+    if ":" not in value and "," not in value:
+        return { "default" : value }
+    keys = {}
+    for entry in value.split(","):
+        kid, separator, secret = entry.strip().partition(":")
+        if not separator or not kid or not secret:
+            raise ValueError("JWT keys must be given as kid:secret, got an entry without a kid or a secret")
+        keys[kid] = secret
+    return keys
+
+
+def _keys_env(name, default):
+    value = os.getenv(name)
+    if not value or not value.strip():
+        return default
+    return parse_keys(value)
+
+
+def _bool_env(name, default=False):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# Serve the routes from an asyncpg-backed AsyncSession instead of the
+# threadpool-bound synchronous session.
+DB_ASYNC = _bool_env("DB_ASYNC")
+
+
+USER_CACHE_TTL_SECONDS = _int_env("USER_CACHE_TTL_SECONDS", 60)
+USER_CACHE_MAX_SIZE = _int_env("USER_CACHE_MAX_SIZE", 10000)
+
+HASH_POOL_WORKERS = _int_env("HASH_POOL_WORKERS", os.cpu_count() or 1)
+HASH_POOL_MAX_PENDING = _int_env("HASH_POOL_MAX_PENDING", 2 * HASH_POOL_WORKERS)
+
+BULK_IMPORT_MAX_ROWS = _int_env("BULK_IMPORT_MAX_ROWS", 5000)
+
+# Reports whose date range ended before today are cached; 0 disables.
+# Entries are keyed on the tasks_version of the users they cover, so a
+# write in any worker makes them unreachable and the TTL only bounds how
+# long they take up memory.
+REPORT_CACHE_TTL_SECONDS = _int_env("REPORT_CACHE_TTL_SECONDS", 86400)
+REPORT_CACHE_MAX_SIZE = _int_env("REPORT_CACHE_MAX_SIZE", 1024)
+
+# Responses smaller than this are sent uncompressed.
+COMPRESSION_MINIMUM_SIZE = _int_env("COMPRESSION_MINIMUM_SIZE", 1024)
+COMPRESSION_GZIP_LEVEL = _int_env("COMPRESSION_GZIP_LEVEL", 6)
+COMPRESSION_BROTLI_QUALITY = _int_env("COMPRESSION_BROTLI_QUALITY", 4)
+
+# With several workers, task events for the WebSocket feed go through
+# LISTEN/NOTIFY so every worker sees them; otherwise they stay in-process.
+TASK_EVENTS_LISTEN = _bool_env("TASK_EVENTS_LISTEN")
+TASK_EVENTS_QUEUE_SIZE = _int_env("TASK_EVENTS_QUEUE_SIZE", 100)
+
+# Development key; set JWT_SECRET_KEYS in any real deployment. Listing an
+# old key after the new one keeps its tokens valid during a rotation.
+JWT_SECRET_KEYS = _keys_env("JWT_SECRET_KEYS", { "dev" : "327b399999b80ff736dc6e5285918902fc1f6cbe290ecd869910f0054558a071" })
+JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+ACCESS_TOKEN_EXPIRE_MINUTES = _int_env("ACCESS_TOKEN_EXPIRE_MINUTES", 30)
+REFRESH_TOKEN_EXPIRE_DAYS = _int_env("REFRESH_TOKEN_EXPIRE_DAYS", 14)
+TOKEN_CACHE_TTL_SECONDS = _int_env("TOKEN_CACHE_TTL_SECONDS", 300)
+TOKEN_CACHE_MAX_SIZE = _int_env("TOKEN_CACHE_MAX_SIZE", 10000)
+
+# Trust the user id and email embedded in access tokens instead of looking
+# the user up. A deleted or renamed user keeps access until the token
+# expires, so keep ACCESS_TOKEN_EXPIRE_MINUTES short when enabling this.
+JWT_TRUSTED_CLAIMS = _bool_env("JWT_TRUSTED_CLAIMS")
+
+# Queries at least this slow are logged with their statement; 0 disables.
+SLOW_QUERY_THRESHOLD_MS = _int_env("SLOW_QUERY_THRESHOLD_MS", 0)
+# Requests running more queries than this are logged, to spot N+1
+# patterns; 0 disables.
+REQUEST_QUERY_WARN_THRESHOLD = _int_env("REQUEST_QUERY_WARN_THRESHOLD", 0)
+
+# "cascade" deletes a user's or project's tasks in the same transaction;
+# "purge" only marks the row deleted and a background task removes the
+# tasks in batches of PURGE_BATCH_SIZE, so a big delete never holds locks
+# for long. Leftovers from a restart are picked up every
+# PURGE_INTERVAL_SECONDS.
+DELETE_MODE = os.getenv("DELETE_MODE", "cascade")
+PURGE_BATCH_SIZE = _int_env("PURGE_BATCH_SIZE", 5000)
+PURGE_INTERVAL_SECONDS = _int_env("PURGE_INTERVAL_SECONDS", 60)
+# Tombstones of deleted tasks older than this are removed by the same
+# background task, in any DELETE_MODE; a client syncing from before them
+# gets 410 and syncs again from scratch. 0 keeps them forever.
+TOMBSTONE_RETENTION_DAYS = _int_env("TOMBSTONE_RETENTION_DAYS", 90)
+
+# Token buckets: logins per client IP, writes per user (or per IP without
+# a token). A rate of 0 turns the limit off. RATE_LIMIT_BACKEND=postgres
+# shares the buckets between workers. Behind a reverse proxy or load
+# balancer every request comes from the proxy's address, so all logins
+# would share one bucket: set RATE_LIMIT_TRUST_FORWARDED_FOR there, and
+# only there, since clients can forge the header when nothing strips it.
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_LOGIN_PER_MINUTE = _int_env("RATE_LIMIT_LOGIN_PER_MINUTE", 10)
+RATE_LIMIT_LOGIN_BURST = _int_env("RATE_LIMIT_LOGIN_BURST", 10)
+RATE_LIMIT_WRITES_PER_SECOND = _int_env("RATE_LIMIT_WRITES_PER_SECOND", 20)
+RATE_LIMIT_WRITES_BURST = _int_env("RATE_LIMIT_WRITES_BURST", 100)
+RATE_LIMIT_TRUST_FORWARDED_FOR = _bool_env("RATE_LIMIT_TRUST_FORWARDED_FOR")
+
+# Requests handled at once per worker; the rest get 503 straight away
+# instead of queueing for a pool connection. 0 disables. Defaults to the
+# connections a worker's pool can hand out.
+ADMISSION_MAX_CONCURRENT = _int_env("ADMISSION_MAX_CONCURRENT", DB_POOL_SIZE + DB_MAX_OVERFLOW)
+
+# "reject" refuses a task whose time overlaps another task of the same
+# user with 409; "allow" keeps the old behaviour.
+TASK_OVERLAP_POLICY = os.getenv("TASK_OVERLAP_POLICY", "allow")
+
+# "group" queues POST /tasks creations and commits them in shared
+# transactions of up to GROUP_COMMIT_MAX_ROWS, after at most
+# GROUP_COMMIT_INTERVAL_MS; requests still answer after their commit.
+# Beyond GROUP_COMMIT_MAX_PENDING waiting rows requests get 503.
+# "direct" commits every request on its own.
+TASK_WRITE_MODE = os.getenv("TASK_WRITE_MODE", "direct")
+GROUP_COMMIT_MAX_ROWS = _int_env("GROUP_COMMIT_MAX_ROWS", 500)
+GROUP_COMMIT_INTERVAL_MS = _int_env("GROUP_COMMIT_INTERVAL_MS", 5)
+GROUP_COMMIT_MAX_PENDING = _int_env("GROUP_COMMIT_MAX_PENDING", 5000)
+
+# With REPLICA_DATABASE_URLS set (see sql.replicas), a client that wrote
+# in the last READ_YOUR_WRITES_SECONDS reads from the primary.
+READ_YOUR_WRITES_SECONDS = _int_env("READ_YOUR_WRITES_SECONDS", 5)
+
+# app.serve: worker processes (0 starts one per available CPU) and the
+# address they share.
+WEB_CONCURRENCY = _int_env("WEB_CONCURRENCY", 0)
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = _int_env("PORT", 80)
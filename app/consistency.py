@@ -0,0 +1,74 @@
+import time
+
+from app.cache import TTLCache
+from app.ratelimit import WRITE_METHODS
+
+COOKIE = "primary_reads_until"
+
+
+class ReadYourWrites:
+    # Clients that wrote in the last window seconds read from the primary,
+    # so they never see a replica from before their own write. Writers are
+    # remembered by user in this process, and by a cookie that any worker
+    # can check for clients that keep cookies.
+
+    def __init__(self, window: float, maxsize: int = 10000, timer=time.time):
+        self.window = window
+        self._timer = timer
+        self._writers = TTLCache(maxsize, window, timer=timer)
+
+    def record(self, user):
+        if user is not None:
+            self._writers.set(user, True)
+        return self._timer() + self.window
+
+    def wrote_recently(self, user, cookie: str = None):
+        if user is not None and self._writers.get(user):
+            return True
+        try:
+            return cookie is not None and float(cookie) > self._timer()
+        except ValueError:
+            return False
+
+    def clear(self):
+        self._writers.clear()
+
+
+class ReadYourWritesMiddleware:
+    # Records successful writes and answers them with the cookie. Logins
+    # write nothing the client reads back. identify_user maps a bearer token
+    # to a user name, or None.
+
+    def __init__(self, app, tracker: ReadYourWrites, identify_user, exempt_paths=("/token", "/token/refresh")):
+        self.app = app
+        self.tracker = tracker
+        self.identify_user = identify_user
+        self.exempt_paths = set(exempt_paths)
+
+    def user(self, headers):
+        for name, value in headers:
+            if name == b"authorization":
+                scheme, _, token = value.decode("latin-1").partition(" ")
+                return self.identify_user(token) if scheme.lower() == "bearer" else None
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] not in WRITE_METHODS
+            or scope["path"] in self.exempt_paths
+            or self.tracker.window <= 0
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                until = self.tracker.record(self.user(scope["headers"]))
+                cookie = "{}={:.3f}; Max-Age={}; Path=/; HttpOnly; SameSite=Lax".format(
+                    COOKIE, until, max(int(self.tracker.window), 1)
+                )
+                message = { **message, "headers" : list(message.get("headers", [])) + [(b"set-cookie", cookie.encode())] }
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
@@ -0,0 +1,72 @@
+import asyncio
+from contextlib import contextmanager
+
+CHANNEL = "task_events"
+
+# Sent in place of events that did not fit a subscriber's queue, or that
+# may have been missed while the LISTEN connection was down. Clients catch
+# up through GET /tasks/changes.
+RESYNC = { "type" : "resync" }
+
+
+def event_keys(event: dict):
+    keys = [("user", event["user_id"])]
+    project_ids = event.get("project_ids") or [event.get("project_id")]
+    keys.extend(("project", project_id) for project_id in project_ids if project_id is not None)
+    return keys
+
+
+class TaskEventBroker:
+    # Fans task events out to the WebSocket subscribers of this process,
+    # keyed by ("user", id) or ("project", id). Each subscriber gets a
+    # bounded queue; one that falls behind is cleared down to a resync
+    # event instead of growing without bound.
+
+    def __init__(self, queue_size: int):
+        self._queue_size = queue_size
+        self._subscribers = {}
+        self._loop = None
+
+    @contextmanager
+    def subscribe(self, key):
+        self._loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(self._queue_size)
+        self._subscribers.setdefault(key, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            queues = self._subscribers.get(key)
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[key]
+
+    def subscriber_count(self):
+        return sum(len(queues) for queues in self._subscribers.values())
+
+    def publish(self, event: dict):
+        for key in event_keys(event):
+            for queue in list(self._subscribers.get(key, ())):
+                self._put(queue, event)
+
+    def resync_all(self):
+        for queues in list(self._subscribers.values()):
+            for queue in list(queues):
+                self._put(queue, RESYNC)
+
+    def _put(self, queue: asyncio.Queue, event: dict):
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(RESYNC)
+
+    def publish_threadsafe(self, event: dict = None):
+        # For the LISTEN thread; event None means notifications were lost.
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        if event is None:
+            loop.call_soon_threadsafe(self.resync_all)
+        else:
+            loop.call_soon_threadsafe(self.publish, event)
@@ -0,0 +1,31 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PoolSaturated(Exception):
+    pass
+
+
+class HashingPool:
+    # Runs bcrypt work off the event loop. bcrypt releases the GIL, so a
+    # thread pool is enough to use several cores. At most max_workers jobs
+    # run and max_pending wait; anything beyond that is rejected right away
+    # instead of queueing without bound.
+
+    def __init__(self, max_workers: int, max_pending: int):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="password-hash")
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+
+    async def run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PoolSaturated()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot is held until the job itself finishes, even if the
+        # awaiting request goes away.
+        future.add_done_callback(lambda _: self._slots.release())
+        return await asyncio.wrap_future(future)
@@ -1,29 +1,106 @@
-from tokenize import Token
-from fastapi import FastAPI, Depends, status, Form, HTTPException
+import anyio
+import asyncio
+import contextlib
+import csv
+import hashlib
+import io
+import orjson
+from fastapi import FastAPI, Depends, status, Form, HTTPException, Query, Request, Response, WebSocket
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 
-from sql import crud, models, schemas
-from sql.database import SessionLocal, engine
-
-from datetime import datetime, timedelta
-from jose import JWTError, jwt
+from sql import async_crud, catalog, crud, partitions, schemas
+from sql.catalog import project_catalog
+from sql.notify import listener
+from sql.replicas import replicas
+from sql.database import SessionLocal, get_engine, get_async_sessionmaker, get_pool_stats
+from app import config, consistency, events, metrics, ratelimit, writebehind
+from app.cache import TTLCache
+from app.compression import CompressionMiddleware
+from app.hashing import HashingPool, PoolSaturated
+from app.purge import Purger
+from app.tokens import REFRESH, TokenService
+
+from datetime import date, datetime, timedelta
+from jose import JWTError
 from typing import Optional, List
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm.session import Session
+from pydantic import ValidationError
 
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
+
+TASKS_PAGE_DEFAULT_LIMIT = 100
+TASKS_PAGE_MAX_LIMIT = 1000
 
-SECRET_KEY = "327b399999b80ff736dc6e5285918902fc1f6cbe290ecd869910f0054558a071"
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
+NDJSON_MEDIA_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonlines")
 
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Resolved users keyed by the token's "sub" claim. Entries are dropped when
+# the user is updated or deleted.
+user_cache = TTLCache(config.USER_CACHE_MAX_SIZE, config.USER_CACHE_TTL_SECONDS)
+
+# Time reports for ranges that ended before today, keyed on the version of
+# the users they cover (see crud.get_report_version), so a write in any
+# worker or by sql.partitions makes the old entry unreachable.
+report_cache = TTLCache(config.REPORT_CACHE_MAX_SIZE, config.REPORT_CACHE_TTL_SECONDS)
+
+token_service = TokenService(
+    config.JWT_SECRET_KEYS,
+    config.JWT_ALGORITHM,
+    TTLCache(config.TOKEN_CACHE_MAX_SIZE, config.TOKEN_CACHE_TTL_SECONDS)
+)
+
+password_pool = HashingPool(config.HASH_POOL_WORKERS, config.HASH_POOL_MAX_PENDING)
+
+task_events = events.TaskEventBroker(config.TASK_EVENTS_QUEUE_SIZE)
+
 origins = [
     "http://localhost:8080"
 ]
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+
+def token_user(token: str):
+    try:
+        return token_service.decode(token).get("sub")
+    except JWTError:
+        return None
+
+rate_limit_backend = (
+    ratelimit.PostgresBackend(get_engine) if config.RATE_LIMIT_BACKEND == "postgres" else ratelimit.MemoryBackend()
+)
+
+read_your_writes = consistency.ReadYourWrites(config.READ_YOUR_WRITES_SECONDS)
+
+# Added innermost first: requests pass metrics, CORS, admission control and
+# rate limiting before compression and the routes.
+if replicas:
+    app.add_middleware(consistency.ReadYourWritesMiddleware, tracker=read_your_writes, identify_user=token_user)
+
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=config.COMPRESSION_MINIMUM_SIZE,
+    gzip_level=config.COMPRESSION_GZIP_LEVEL,
+    brotli_quality=config.COMPRESSION_BROTLI_QUALITY,
+)
+
+app.add_middleware(
+    ratelimit.RateLimitMiddleware,
+    backend=rate_limit_backend,
+    login_rate=ratelimit.Rate(config.RATE_LIMIT_LOGIN_BURST, config.RATE_LIMIT_LOGIN_PER_MINUTE / 60),
+    write_rate=ratelimit.Rate(config.RATE_LIMIT_WRITES_BURST, config.RATE_LIMIT_WRITES_PER_SECOND),
+    identify_user=token_user,
+    trust_forwarded_for=config.RATE_LIMIT_TRUST_FORWARDED_FOR,
+)
+
+app.add_middleware(
+    ratelimit.AdmissionMiddleware,
+    limiter=ratelimit.ConcurrencyLimiter(config.ADMISSION_MAX_CONCURRENT),
+    exempt_paths=("/", "/metrics"),
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -33,137 +110,452 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-def get_db():
-    db = SessionLocal()
+app.add_middleware(metrics.MetricsMiddleware, query_warn_threshold=config.REQUEST_QUERY_WARN_THRESHOLD)
+
+metrics.instrument_queries(config.SLOW_QUERY_THRESHOLD_MS / 1000)
+
+def pool_gauges():
+    gauges = {}
+    for pool_name, stats in { **get_pool_stats(), **replicas.pool_stats() }.items():
+        for stat, value in stats.items():
+            name = "db_pool_{}".format(stat)
+            gauges.setdefault(name, ("Connection pool {}".format(stat.replace("_", " ")), {}))[1][(("pool",), (pool_name,))] = value
+    return gauges
+
+metrics.registry.add_collector(pool_gauges)
+
+def replica_gauges():
+    labels = lambda replica: (("replica",), (replica.name,))
+    return {
+        "db_replica_healthy" : ("Replica in rotation", {
+            labels(replica) : int(replica.healthy) for replica in replicas.replicas
+        }),
+        "db_replica_lag_seconds" : ("Replication lag at the last check", {
+            labels(replica) : replica.lag for replica in replicas.replicas if replica.lag is not None
+        }),
+    }
+
+metrics.registry.add_collector(replica_gauges)
+
+if config.DB_ASYNC:
+    async def get_db():
+        async with get_async_sessionmaker()() as db:
+            yield db
+else:
+    def get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+def read_replica(request: Request):
+    if not replicas:
+        return None
+    cookie = request.cookies.get(consistency.COOKIE)
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    user = token_user(token) if scheme.lower() == "bearer" else None
+    if read_your_writes.wrote_recently(user, cookie):
+        return None
+    return replicas.choose()
+
+# Sessions for the read-only routes: a replica when one is healthy and the
+# client has not written lately, otherwise the request's primary session.
+# The replica connection is checked out up front, so an unreachable replica
+# is taken out and the request falls back to the primary.
+if config.DB_ASYNC:
+    async def get_read_db(request: Request, db = Depends(get_db)):
+        replica = read_replica(request)
+        if replica is None:
+            yield db
+            return
+        async with replica.async_session() as replica_db:
+            try:
+                await replica_db.connection()
+            except (OperationalError, OSError):
+                replica.mark_down("connection failed")
+                replica_db = db
+            yield replica_db
+else:
+    def get_read_db(request: Request, db = Depends(get_db)):
+        replica = read_replica(request)
+        if replica is None:
+            yield db
+            return
+        replica_db = replica.session()
+        try:
+            replica_db.connection()
+        except (OperationalError, OSError):
+            replica.mark_down("connection failed")
+            replica_db.close()
+            yield db
+            return
+        try:
+            yield replica_db
+        finally:
+            replica_db.close()
+
+@contextlib.asynccontextmanager
+async def open_db():
+    # A session outside of a request, for background work
+    if config.DB_ASYNC:
+        async with get_async_sessionmaker()() as db:
+            yield db
+    else:
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            await anyio.to_thread.run_sync(db.close)
+
+purge_later = config.DELETE_MODE == "purge"
+reject_overlaps = config.TASK_OVERLAP_POLICY == "reject"
+purger = Purger(
+    open_db,
+    config.PURGE_BATCH_SIZE,
+    config.PURGE_INTERVAL_SECONDS,
+    config.TOMBSTONE_RETENTION_DAYS * 86400
+)
+
+task_writer = writebehind.GroupCommitQueue(
+    open_db,
+    lambda db, entries: async_crud.create_task_batch(db, entries, reject_overlaps),
+    config.GROUP_COMMIT_MAX_ROWS,
+    config.GROUP_COMMIT_INTERVAL_MS / 1000,
+    config.GROUP_COMMIT_MAX_PENDING
+) if config.TASK_WRITE_MODE == "group" else None
+
+if catalog.PROJECT_CATALOG_LISTEN:
+    listener.subscribe(catalog.CHANNEL, project_catalog.invalidate)
+
+if config.TASK_EVENTS_LISTEN:
+    listener.subscribe(events.CHANNEL, lambda payload: task_events.publish_threadsafe(
+        None if payload is None else orjson.loads(payload)
+    ))
+
+@app.on_event("startup")
+def start_listener():
+    if catalog.PROJECT_CATALOG_LISTEN or config.TASK_EVENTS_LISTEN:
+        listener.start()
+
+@app.on_event("shutdown")
+def stop_listener():
+    listener.stop()
+
+replica_watch = None
+partition_watch = None
+
+@app.on_event("startup")
+async def start_replica_watch():
+    global replica_watch
+    if replicas:
+        replica_watch = asyncio.get_running_loop().create_task(replicas.watch())
+
+@app.on_event("shutdown")
+async def stop_replica_watch():
+    global replica_watch
+    if replica_watch is not None:
+        replica_watch.cancel()
+        replica_watch = None
+
+@app.on_event("startup")
+async def start_partition_watch():
+    # Keeps partitions for the coming periods of task_date in place
+    global partition_watch
+    if partitions.TASK_PARTITION_CHECK_SECONDS > 0:
+        partition_watch = asyncio.get_running_loop().create_task(partitions.watch(get_engine))
+
+@app.on_event("shutdown")
+async def stop_partition_watch():
+    global partition_watch
+    if partition_watch is not None:
+        partition_watch.cancel()
+        partition_watch = None
+
+@app.on_event("startup")
+async def start_purger():
+    if purge_later or config.TOMBSTONE_RETENTION_DAYS > 0:
+        purger.start()
+
+@app.on_event("shutdown")
+async def stop_purger():
+    await purger.stop()
+
+@app.on_event("shutdown")
+async def stop_task_writer():
+    if task_writer is not None:
+        await task_writer.stop()
+
+def etag_matches(request: Request, etag: str):
+    header = request.headers.get("if-none-match")
+    if header is None:
+        return False
+    if header.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison
+    strip_weak = lambda tag: tag.strip()[2:] if tag.strip().startswith("W/") else tag.strip()
+    return strip_weak(etag) in [strip_weak(tag) for tag in header.split(",")]
+
+def weak_etag(*parts):
+    return body_etag("|".join(str(part) for part in parts).encode())
+
+def body_etag(body: bytes):
+    return 'W/"{}"'.format(hashlib.sha1(body).hexdigest()[:20])
+
+def not_modified(etag: str):
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={ "ETag" : etag })
+
+async def run_password_task(fn, *args):
     try:
-        yield db
-    finally:
-        db.close()
+        return await password_pool.run(fn, *args)
+    except PoolSaturated:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server is busy, please retry",
+            headers={"Retry-After" : "1"}
+        )
 
-def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
-    to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
+def too_many_rows():
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail="At most {} tasks can be imported at once".format(config.BULK_IMPORT_MAX_ROWS)
+    )
+
+async def read_bulk_items(request: Request):
+    # Returns the raw rows of a bulk import, either a JSON array or an NDJSON
+    # stream, as (index, row). NDJSON lines are split as they arrive and
+    # decoded later so that a bad line only fails its own row. An NDJSON
+    # row's index is its line number from 0, blank lines included.
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type not in NDJSON_MEDIA_TYPES:
+        try:
+            items = orjson.loads(await request.body())
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Body must be a JSON array of tasks")
+        if not isinstance(items, list):
+            raise HTTPException(status_code=400, detail="Body must be a JSON array of tasks")
+        if len(items) > config.BULK_IMPORT_MAX_ROWS:
+            raise too_many_rows()
+        return list(enumerate(items))
+
+    items = []
+    line_count = 0
+    pending = b""
+    async for chunk in request.stream():
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        items.extend((line_count + number, line) for number, line in enumerate(lines) if line.strip())
+        line_count += len(lines)
+        if len(items) > config.BULK_IMPORT_MAX_ROWS:
+            raise too_many_rows()
+    if pending.strip():
+        items.append((line_count, pending))
+    if len(items) > config.BULK_IMPORT_MAX_ROWS:
+        raise too_many_rows()
+    return items
+
+async def export_csv(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(crud.TASK_EXPORT_FIELDS)
+    yield buffer.getvalue()
+    async for rows in batches:
+        buffer.seek(0)
+        buffer.truncate(0)
+        writer.writerows(rows)
+        yield buffer.getvalue()
+
+async def export_ndjson(batches):
+    async for rows in batches:
+        yield b"".join(
+            orjson.dumps(dict(zip(crud.TASK_EXPORT_FIELDS, row)), option=orjson.OPT_APPEND_NEWLINE) for row in rows
+        )
+
+def overlap_conflict(error: crud.TaskOverlapError):
+    return HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(error))
+
+async def publish_task_event(db: Session, event: dict):
+    # Through NOTIFY every worker, this one included, gets the event from its
+    # listener; otherwise it only goes to this process' subscribers.
+    if config.TASK_EVENTS_LISTEN:
+        await async_crud.send_notification(db, events.CHANNEL, orjson.dumps(event).decode())
     else:
-        expire = datetime.utcnow() + timedelta(minutes = 15)
-    
-    to_encode.update({ "exp" : expire })
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm = ALGORITHM)
-    return encoded_jwt
+        task_events.publish(event)
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
-    credentials_exception = HTTPException(
+def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
+    return token_service.encode(data, expires_delta or timedelta(minutes=15))
+
+def create_tokens(user):
+    claims = { "sub" : user.user_name }
+    if config.JWT_TRUSTED_CLAIMS:
+        claims.update(uid=user.id, email=user.email)
+    return {
+        "access_token" : create_access_token(claims, timedelta(minutes=config.ACCESS_TOKEN_EXPIRE_MINUTES)),
+        "refresh_token" : token_service.encode(
+            { "sub" : user.user_name }, timedelta(days=config.REFRESH_TOKEN_EXPIRE_DAYS), REFRESH
+        ),
+        "token_type" : "bearer"
+    }
+
+def credentials_exception():
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate" : "Bearer"}
     )
+
+async def current_user_from(token: str, db: Session):
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        print("username is {}".format(username))
-        if username is None:
-            raise credentials_exception
-        token_data = schemas.TokenData(username=username)
+        payload = token_service.decode(token)
     except JWTError:
-        raise credentials_exception
+        raise credentials_exception()
+    username = payload.get("sub")
+    if username is None:
+        raise credentials_exception()
 
-    print(token_data)
-    db = next(get_db())
-    user = crud.get_user_by_username(db, token_data.username)
-    print(user)
-    if user is None:
-        raise credentials_exception
+    if config.JWT_TRUSTED_CLAIMS and "uid" in payload:
+        return schemas.User(id=payload["uid"], user_name=username, email=payload.get("email"))
+
+    user = user_cache.get(username)
+    if user is not None:
+        return user
+
+    db_user = await async_crud.get_user_by_username(db, username)
+    if db_user is None:
+        raise credentials_exception()
+    user = schemas.User.from_orm(db_user)
+    user_cache.set(username, user)
     return user
 
+async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    return await current_user_from(token, db)
+
+async def get_current_read_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_read_db)):
+    # For read-only routes, so a cache miss does not need the primary
+    return await current_user_from(token, db)
+
 @app.get("/")
 async def root():
     return { "message" : "Hello World" }
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/stats/db")
+async def get_db_stats():
+    return { **get_pool_stats(), **replicas.pool_stats() }
+
 @app.post("/token", response_model=schemas.Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = crud.authenticate_user(db, form_data.username, form_data.password)
-    if not user:
+    user = await async_crud.get_user_by_username(db, form_data.username)
+    if not user or not await run_password_task(crud.verify_password, form_data.password, user.password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate" : "Bearer"}
         )
 
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={ "sub" : user.user_name },
-        expires_delta=access_token_expires
-    )
-
     return { 
-        "access_token" : access_token, 
-        "token_type" : "bearer", 
+        **create_tokens(user),
         "user" : { "username" : user.user_name, "email" : user.email } 
     }
 
+@app.post("/token/refresh", response_model=schemas.Token)
+async def refresh_access_token(body: schemas.RefreshRequest, db: Session = Depends(get_db)):
+    # Trades a refresh token for a new pair without going through bcrypt.
+    # The user is looked up so deleted users cannot refresh.
+    try:
+        payload = token_service.decode(body.refresh_token, REFRESH)
+    except JWTError:
+        raise credentials_exception()
+    user = await async_crud.get_user_by_username(db, payload.get("sub"))
+    if user is None:
+        raise credentials_exception()
+    return create_tokens(user)
+
 @app.get("/users", response_model=List[schemas.User])
-def get_users(db: Session = Depends(get_db)):
-    return crud.get_users(db)
+async def get_users(request: Request, db: Session = Depends(get_read_db)):
+    # Rows go straight to orjson; no ORM objects or response_model pass.
+    # The ETag is a hash of the body, which saves the transfer but not the query.
+    body = orjson.dumps(await async_crud.get_user_rows(db))
+    etag = body_etag(body)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    return Response(body, media_type="application/json", headers={ "ETag" : etag })
 
 @app.get("/users/{user_id}", response_model=schemas.User)
-def get_user(user_id: int, db: Session = Depends(get_db)):
-    user = crud.get_user(db, user_id)
+async def get_user(user_id: int, db: Session = Depends(get_read_db)):
+    user = await async_crud.get_user(db, user_id)
     if user is None:
         raise HTTPException(status_code=404, detail="User not found")
     return user
 
 @app.post("/users", response_model=schemas.User)
 async def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_username(db, user.user_name)
+    db_user = await async_crud.get_user_by_username(db, user.user_name, include_deleted=True)
     if db_user:
         raise HTTPException(status_code=400, detail="User already exists")
     
-    return crud.create_user(db, user)
+    hashed_password = await run_password_task(crud.get_password_hash, user.password)
+    return await async_crud.create_user(db, user, hashed_password)
 
 @app.patch("/users/{user_id}", response_model=schemas.User)
-def update_user(user_id: int, user: schemas.UserBase, db: Session = Depends(get_db)):
-    db_user = crud.get_user(db, user_id)
+async def update_user(user_id: int, user: schemas.UserBase, db: Session = Depends(get_db)):
+    db_user = await async_crud.get_user(db, user_id)
     if db_user is None:
         raise HTTPException(status_code=400, detail="User not found")
+    cached_name = db_user.user_name
     model_user = schemas.User(**db_user.__dict__)
     updated_data = user.dict(exclude_unset=True)
     updated_user = model_user.copy(update=updated_data)
-    return crud.update_user(db, user_id, updated_user)
+    db_user = await async_crud.update_user(db, user_id, updated_user)
+    user_cache.pop(cached_name)
+    return db_user
 
 @app.delete("/users/{user_id}")
-def delete_user(user_id: int, db: Session = Depends(get_db)):
-    db_user = crud.get_user(db, user_id)
+async def delete_user(user_id: int, db: Session = Depends(get_db)):
+    db_user = await async_crud.get_user(db, user_id)
     if db_user is None:
         raise HTTPException(status_code=400, detail="User does not exist")
-    crud.delete_task_by_user_id(db, user_id)
-    crud.delete_user(db, user_id)
+    cached_name = db_user.user_name
+    await async_crud.delete_user(db, user_id, purge_later)
+    user_cache.pop(cached_name)
+    if purge_later:
+        purger.wake()
 
 @app.get("/users/me/", response_model=schemas.User)
-async def read_users_me(current_user: schemas.User = Depends(get_current_user)):
+async def read_users_me(current_user: schemas.User = Depends(get_current_read_user)):
     return current_user
 
+# The project routes stay on the primary: they are served from the catalog,
+# and a snapshot loaded from a lagging replica would be kept for its TTL.
 @app.get("/projects", response_model=List[schemas.Project])
-def get_projects(db: Session = Depends(get_db)):
-    return crud.get_projects(db)
+async def get_projects(request: Request, db: Session = Depends(get_db)):
+    snapshot = await async_crud.get_project_catalog(db)
+    if etag_matches(request, snapshot.etag):
+        return not_modified(snapshot.etag)
+    return ORJSONResponse(snapshot.projects, headers={ "ETag" : snapshot.etag })
 
 @app.get("/projects/{project_id}", response_model=schemas.Project)
-def get_project(project_id: int, db: Session = Depends(get_db)):
-    db_project = crud.get_project(db, project_id)
+async def get_project(project_id: int, db: Session = Depends(get_db)):
+    snapshot = await async_crud.get_project_catalog(db)
+    db_project = snapshot.by_id.get(project_id)
     if db_project is None:
         raise HTTPException(status_code=400, detail="Project does not exist")
 
     return db_project 
 
 @app.post("/projects", response_model=schemas.Project)
-def create_project(project: schemas.ProjectCreate, db: Session = Depends(get_db)):
-    db_project = crud.get_project_by_title(db, project.name)
+async def create_project(project: schemas.ProjectCreate, db: Session = Depends(get_db)):
+    db_project = await async_crud.get_project_by_title(db, project.name, include_deleted=True)
     if db_project:
         raise HTTPException(status_code=400, detail="Project already exists")
-    return crud.create_project(db, project)
+    return await async_crud.create_project(db, project)
 
 @app.patch("/projects/{project_id}", response_model=schemas.Project)
-def update_project(project_id: int, project: schemas.ProjectCreate, db: Session = Depends(get_db)):
-    db_project = crud.get_project(db, project_id)
+async def update_project(project_id: int, project: schemas.ProjectCreate, db: Session = Depends(get_db)):
+    db_project = await async_crud.get_project(db, project_id)
     if db_project is None:
         raise HTTPException(status_code=400, detail="Project does not exist")
 
@@ -171,34 +563,205 @@ def update_project(project_id: int, project: schemas.ProjectCreate, db: Session
     updated_data = project.dict(exclude_unset=True)
     updated_project = model_project.copy(update=updated_data)
 
-    return crud.update_project(db, project_id, updated_project)
+    db_project = await async_crud.update_project(db, project_id, updated_project)
+    return db_project
 
 @app.delete("/projects/{project_id}")
-def delete_project(project_id: int, db: Session = Depends(get_db)):
-    db_project = crud.get_project(db, project_id)
+async def delete_project(project_id: int, db: Session = Depends(get_db)):
+    db_project = await async_crud.get_project(db, project_id)
     if db_project is None:
         raise HTTPException(status_code=400, detail="Project does not exist")
-    crud.delete_task_by_project_id(db, project_id)
-    crud.delete_project(db, project_id)
+    await async_crud.delete_project(db, project_id, purge_later)
+    if purge_later:
+        purger.wake()
     return { "success" : True }
 
+@app.get("/reports/time")
+async def get_time_report(
+    period: Optional[str] = Query(None, regex="^(day|week|month)$"),
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    user_id: Optional[int] = None,
+    all_users: bool = False,
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_user)
+):
+    report_user_id = None if all_users else (user_id or current_user.id)
+    cacheable = date_to is not None and date_to < date.today()
+    if cacheable:
+        version = await async_crud.get_report_version(db, report_user_id)
+        cache_key = (report_user_id, version, period, date_from, date_to)
+        report = report_cache.get(cache_key)
+        if report is not None:
+            return ORJSONResponse(report)
+
+    report = await async_crud.get_time_report(db, report_user_id, period, date_from, date_to)
+    if cacheable:
+        report_cache.set(cache_key, report)
+    return ORJSONResponse(report)
+
 @app.get("/tasks")
-def get_tasks(db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    db_tasks = crud.get_tasks_by_user(db, current_user.id)
-    return db_tasks
+async def get_tasks(
+    request: Request,
+    limit: int = Query(TASKS_PAGE_DEFAULT_LIMIT, ge=1, le=TASKS_PAGE_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    project_id: Optional[int] = None,
+    db: Session = Depends(get_read_db),
+    current_user = Depends(get_current_read_user)
+):
+    # Every task write bumps the owner's tasks_version, so an unchanged
+    # version means an unchanged page and the page query can be skipped.
+    # The version is read before the page: a write landing in between only
+    # costs the client one extra refetch.
+    etag = None
+    version = await async_crud.get_tasks_version(db, current_user.id)
+    if version is not None:
+        etag = weak_etag(current_user.id, version, limit, cursor, date_from, date_to, project_id)
+        if etag_matches(request, etag):
+            return not_modified(etag)
+
+    try:
+        page = await async_crud.get_tasks_page(
+            db,
+            current_user.id,
+            limit,
+            cursor=cursor,
+            date_from=date_from,
+            date_to=date_to,
+            project_id=project_id
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return ORJSONResponse(page, headers={ "ETag" : etag } if etag else None)
+
+@app.get("/tasks/activity")
+async def get_activity(
+    start: datetime,
+    end: datetime,
+    user_id: Optional[int] = None,
+    project_id: Optional[int] = None,
+    limit: int = Query(TASKS_PAGE_MAX_LIMIT, ge=1, le=TASKS_PAGE_MAX_LIMIT),
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_user)
+):
+    # What a user or a project was doing between start and end; the caller's
+    # own tasks when neither is given.
+    if end <= start:
+        raise HTTPException(status_code=400, detail="end must be after start")
+    if user_id is None and project_id is None:
+        user_id = current_user.id
+    return ORJSONResponse(await async_crud.get_activity(db, start, end, user_id, project_id, limit))
+
+@app.get("/tasks/overlaps")
+async def get_overlapping_tasks(
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_user)
+):
+    return ORJSONResponse(await async_crud.get_overlapping_tasks(db, current_user.id, date_from, date_to))
+
+@app.get("/tasks/changes")
+async def get_task_changes(
+    since: Optional[int] = Query(None, ge=0),
+    cursor: Optional[str] = None,
+    limit: int = Query(TASKS_PAGE_DEFAULT_LIMIT, ge=1, le=TASKS_PAGE_MAX_LIMIT),
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_user)
+):
+    try:
+        changes = await async_crud.get_task_changes(db, current_user.id, limit, since=since, cursor=cursor)
+    except crud.ChangesPrunedError as e:
+        raise HTTPException(status_code=410, detail="{}; sync again without since".format(e))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if changes is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return ORJSONResponse(changes)
 
 @app.post("/tasks")
-def create_task(task: schemas.TaskCreate, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    return crud.create_task(db, task, current_user.id)
+async def create_task(task: schemas.TaskCreate, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
+    try:
+        if task_writer is not None:
+            db_task = await task_writer.submit((current_user.id, task))
+        else:
+            db_task = await async_crud.create_task(db, task, current_user.id, reject_overlaps)
+    except crud.TaskOverlapError as e:
+        raise overlap_conflict(e)
+    except crud.ProjectNotFoundError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except writebehind.QueueFull:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server is busy, please retry",
+            headers={ "Retry-After" : "1" }
+        )
+    await publish_task_event(db, {
+        "type" : "task.created",
+        "user_id" : current_user.id,
+        "project_id" : task.project_id,
+        "task" : db_task
+    })
+    return db_task
+
+@app.get("/tasks/export")
+async def export_tasks(
+    format: str = Query("csv", regex="^(csv|ndjson)$"),
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_user)
+):
+    batches = async_crud.stream_tasks_by_user(db, current_user.id, date_from, date_to)
+    if format == "csv":
+        body, media_type = export_csv(batches), "text/csv"
+    else:
+        body, media_type = export_ndjson(batches), "application/x-ndjson"
+
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={ "Content-Disposition" : 'attachment; filename="tasks.{}"'.format(format) }
+    )
+
+@app.post("/tasks/bulk")
+async def bulk_create_tasks(request: Request, atomic: bool = False, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
+    tasks = []
+    errors = []
+    for index, item in await read_bulk_items(request):
+        try:
+            if isinstance(item, bytes):
+                item = orjson.loads(item)
+            tasks.append((index, schemas.TaskCreate.parse_obj(item)))
+        except ValidationError as e:
+            errors.append({ "index" : index, "detail" : e.errors() })
+        except ValueError:
+            errors.append({ "index" : index, "detail" : "Invalid JSON" })
+
+    if atomic and errors:
+        raise HTTPException(status_code=422, detail=errors)
+
+    result = await async_crud.bulk_create_tasks(db, tasks, current_user.id, atomic, reject_overlaps)
+    if atomic and result["errors"]:
+        raise HTTPException(status_code=422, detail=result["errors"])
+
+    result["errors"] = sorted(errors + result["errors"], key=lambda error: error["index"])
+    if result["created"]:
+        # One summary event; the tasks themselves come from GET /tasks/changes
+        await publish_task_event(db, {
+            "type" : "tasks.bulk_created",
+            "user_id" : current_user.id,
+            "project_ids" : sorted({ task["project_id"] for task in result["created"] }),
+            "count" : len(result["created"])
+        })
+    return result
 
 @app.patch("/tasks/{task_id}")
-def update_task(task_id: int, task: schemas.TaskCreate, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    print(task)
-    db_task = crud.get_task(db, task_id)
-    if db_task is None:
-        raise HTTPException(status_code=400, detail="Task logged does not exist")
+async def update_task(task_id: int, task: schemas.TaskCreate, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
     updated_task = schemas.Task(
-        id=db_task.id,
+        id=task_id,
         user_id=current_user.id,
         project_id=task.project_id,
         start_time=task.start_time,
@@ -208,15 +771,62 @@ def update_task(task_id: int, task: schemas.TaskCreate, db: Session = Depends(ge
         description=task.description
     )
 
-    return crud.update_task(db, task_id, updated_task)
+    try:
+        db_task = await async_crud.update_task(db, task_id, updated_task, reject_overlaps)
+    except crud.TaskOverlapError as e:
+        raise overlap_conflict(e)
+    except crud.ProjectNotFoundError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if db_task is None:
+        raise HTTPException(status_code=400, detail="Task logged does not exist")
+    await publish_task_event(db, {
+        "type" : "task.updated",
+        "user_id" : current_user.id,
+        "project_id" : task.project_id,
+        "task" : db_task
+    })
+    return db_task
 
 @app.delete("/tasks/{task_id}")
-def delete_task(task_id: int, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    db_task = crud.get_task(db, task_id)
+async def delete_task(task_id: int, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
+    db_task = await async_crud.get_task(db, task_id)
     if db_task is None:
         raise HTTPException(status_code=400, detail="Task logged does not exist")
     
-    return crud.delete_task(db, task_id)
+    event = {
+        "type" : "task.deleted",
+        "user_id" : db_task.user_id,
+        "project_id" : db_task.project_id,
+        "task_id" : task_id
+    }
+    result = await async_crud.delete_task(db, task_id)
+    await publish_task_event(db, event)
+    return result
+
+@app.websocket("/ws/tasks")
+async def task_event_feed(websocket: WebSocket, token: str, project_id: Optional[int] = None, db: Session = Depends(get_db)):
+    # Browsers cannot set headers on a WebSocket, so the token comes in the
+    # query string. Subscribes to the user's own tasks, or to a project's.
+    try:
+        current_user = await get_current_user(token, db)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await async_crud.end_transaction(db)
+
+    await websocket.accept()
+    key = ("user", current_user.id) if project_id is None else ("project", project_id)
+    with task_events.subscribe(key) as queue:
+        async def forward():
+            while True:
+                await websocket.send_text(orjson.dumps(await queue.get()).decode())
+
+        sender = asyncio.create_task(forward())
+        try:
+            while (await websocket.receive())["type"] != "websocket.disconnect":
+                pass
+        finally:
+            sender.cancel()
 
 
 
@@ -0,0 +1,228 @@
+# Request and query instrumentation in the Prometheus text format.
+#
+# The registry is kept in-process and rendered by GET /metrics, so nothing
+# beyond SQLAlchemy's event hooks is needed. With several workers each one
+# reports its own numbers; scrape them separately or aggregate by instance.
+import bisect
+import contextvars
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} counter".format(self.name)]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append("{}{} {}".format(self.name, format_labels(self.labels, label_values), value))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # per-bucket counts (the last one is +Inf), sum, count
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, *label_values):
+        series = self._series.get(label_values)
+        return 0 if series is None else series[2]
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} histogram".format(self.name)]
+        with self._lock:
+            for label_values, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += bucket_count
+                    labels = format_labels(self.labels + ("le",), label_values + (bound,))
+                    lines.append("{}_bucket{} {}".format(self.name, labels, cumulative))
+                labels = format_labels(self.labels, label_values)
+                lines.append("{}_sum{} {}".format(self.name, labels, total))
+                lines.append("{}_count{} {}".format(self.name, labels, count))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        # collector() returns {name: (help, {labels tuple: value})} for gauges
+        # read at scrape time, such as pool stats.
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            for name, (help, samples) in collector().items():
+                lines.append("# HELP {} {}".format(name, help))
+                lines.append("# TYPE {} gauge".format(name))
+                for (label_names, label_values), value in samples.items():
+                    lines.append("{}{} {}".format(name, format_labels(label_names, label_values), value))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+request_duration = registry.register(Histogram(
+    "http_request_duration_seconds", "HTTP request latency", ("method", "route", "status")
+))
+request_queries = registry.register(Histogram(
+    "http_request_db_queries", "Database queries run per HTTP request", ("route",), QUERY_COUNT_BUCKETS
+))
+request_query_duration = registry.register(Histogram(
+    "http_request_db_query_seconds", "Time spent in database queries per HTTP request", ("route",)
+))
+queries_total = registry.register(Counter("db_queries_total", "Database queries run"))
+query_duration = registry.register(Histogram("db_query_duration_seconds", "Database query latency"))
+slow_queries_total = registry.register(Counter("db_slow_queries_total", "Queries over the slow query threshold"))
+
+
+class RequestStats:
+    __slots__ = ("route", "queries", "query_seconds")
+
+    def __init__(self):
+        self.route = None
+        self.queries = 0
+        self.query_seconds = 0.0
+
+
+# Set per request by MetricsMiddleware. The object is shared, not copied,
+# so queries run in worker threads or through run_sync are counted too.
+current_request = contextvars.ContextVar("current_request", default=None)
+
+
+_slow_query_seconds = 0
+_instrumented = False
+
+
+def instrument_queries(slow_query_seconds: float = 0):
+    # Hooks every Engine, including the sync side of async engines. Calling
+    # it again only changes the slow query threshold.
+    global _slow_query_seconds, _instrumented
+    _slow_query_seconds = slow_query_seconds
+    if _instrumented:
+        return
+    _instrumented = True
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        queries_total.inc()
+        query_duration.observe(elapsed)
+        stats = current_request.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.query_seconds += elapsed
+        if _slow_query_seconds and elapsed >= _slow_query_seconds:
+            slow_queries_total.inc()
+            logger.warning(
+                "Slow query (%.1f ms) in %s: %s",
+                elapsed * 1000, stats.route if stats is not None else "-", " ".join(statement.split())[:1000]
+            )
+
+    def handle_error(context):
+        # after_cursor_execute is skipped for failed statements
+        starts = context.connection.info.get("query_start") if context.connection is not None else None
+        if starts:
+            starts.pop()
+
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(Engine, "handle_error", handle_error)
+
+
+class MetricsMiddleware:
+    # Times each HTTP request and counts its queries, labelled by the route
+    # template ("/tasks/{task_id}") rather than the raw path.
+
+    def __init__(self, app, query_warn_threshold: int = 0):
+        self.app = app
+        self.query_warn_threshold = query_warn_threshold
+        self._route_paths = None
+
+    def route_path(self, scope):
+        if self._route_paths is None:
+            self._route_paths = { route.endpoint : route.path for route in scope["app"].routes if hasattr(route, "endpoint") }
+        return self._route_paths.get(scope.get("endpoint"), "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                stats.route = self.route_path(scope)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            current_request.reset(token)
+            route = stats.route or self.route_path(scope)
+            request_duration.observe(time.perf_counter() - start, scope["method"], route, status_code)
+            request_queries.observe(stats.queries, route)
+            request_query_duration.observe(stats.query_seconds, route)
+            if self.query_warn_threshold and stats.queries > self.query_warn_threshold:
+                logger.warning("%s %s ran %d queries", scope["method"], route, stats.queries)
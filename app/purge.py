@@ -0,0 +1,68 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+from sql import async_crud
+
+logger = logging.getLogger(__name__)
+
+
+class Purger:
+    # Background task for DELETE_MODE=purge: removes the tasks of users and
+    # projects marked deleted, one committed batch at a time, then the rows
+    # themselves. Woken by deletes, and otherwise runs every interval to pick
+    # up work left by a restart or another worker. With a
+    # tombstone_retention (seconds) older tombstones go as well.
+
+    def __init__(self, open_session, batch_size: int, interval: float, tombstone_retention: float = 0):
+        self._open_session = open_session
+        self._batch_size = batch_size
+        self._interval = interval
+        self._tombstone_retention = tombstone_retention
+        self._wake = None
+        self._task = None
+
+    def wake(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    def start(self):
+        if self._task is None:
+            # Made here: an Event belongs to the loop it is first used in
+            self._wake = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def purge(self):
+        total = 0
+        tombstones_before = None
+        if self._tombstone_retention > 0:
+            tombstones_before = datetime.now(timezone.utc) - timedelta(seconds=self._tombstone_retention)
+        async with self._open_session() as db:
+            while True:
+                removed = await async_crud.purge_deleted(db, self._batch_size, tombstones_before)
+                if not removed:
+                    return total
+                total += removed
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                removed = await self.purge()
+                if removed:
+                    logger.info("Purged %d tasks of deleted users and projects and expired tombstones", removed)
+            except Exception:
+                logger.exception("Purge failed")
+            try:
+                await asyncio.wait_for(self._wake.wait(), self._interval)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,195 @@
+# Token-bucket rate limiting and a global concurrency cap.
+#
+# Buckets live in a backend: MemoryBackend keeps them in the process,
+# PostgresBackend in the rate_limit_buckets table so that every worker
+# shares them. A backend only has to implement acquire().
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+import anyio
+import orjson
+from sqlalchemy import text
+
+WRITE_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+
+
+class Rate(NamedTuple):
+    capacity: float
+    per_second: float
+
+
+class MemoryBackend:
+    blocking = False
+
+    def __init__(self, max_keys: int = 100000, timer=time.monotonic):
+        self._buckets = OrderedDict()
+        self._max_keys = max_keys
+        self._timer = timer
+        self._lock = threading.Lock()
+
+    def acquire(self, key: str, rate: Rate, cost: float = 1):
+        # Returns 0 when allowed, otherwise the seconds until it would be.
+        now = self._timer()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (rate.capacity, now))
+            tokens = min(rate.capacity, tokens + (now - updated) * rate.per_second)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self._max_keys:
+                self._buckets.popitem(last=False)
+        return 0 if allowed else (cost - tokens) / rate.per_second
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class PostgresBackend:
+    # One upsert per check, refilling and spending in the same statement.
+    # Costs a pooled connection per limited request, so it belongs behind
+    # the concurrency limiter.
+    blocking = True
+
+    ACQUIRE = text("""
+        INSERT INTO rate_limit_buckets AS bucket (key, tokens, updated_at)
+        VALUES (:key, :capacity - :cost, clock_timestamp())
+        ON CONFLICT (key) DO UPDATE SET
+            tokens = LEAST(:capacity, bucket.tokens + EXTRACT(EPOCH FROM clock_timestamp() - bucket.updated_at) * :rate) - :cost,
+            updated_at = clock_timestamp()
+        WHERE LEAST(:capacity, bucket.tokens + EXTRACT(EPOCH FROM clock_timestamp() - bucket.updated_at) * :rate) >= :cost
+        RETURNING tokens
+    """)
+    AVAILABLE = text("""
+        SELECT LEAST(:capacity, tokens + EXTRACT(EPOCH FROM clock_timestamp() - updated_at) * :rate)
+        FROM rate_limit_buckets WHERE key = :key
+    """)
+
+    def __init__(self, engine):
+        # An Engine, or a callable returning one so that it is only created
+        # in the worker processes.
+        self._engine = engine
+
+    def acquire(self, key: str, rate: Rate, cost: float = 1):
+        params = { "key" : key, "capacity" : rate.capacity, "rate" : rate.per_second, "cost" : cost }
+        engine = self._engine() if callable(self._engine) else self._engine
+        with engine.begin() as connection:
+            if connection.execute(self.ACQUIRE, params).first() is not None:
+                return 0
+            tokens = connection.execute(self.AVAILABLE, params).scalar() or 0
+        return max(cost - tokens, 0) / rate.per_second
+
+
+class ConcurrencyLimiter:
+    # Requests beyond the limit are refused at once rather than queued, so
+    # a burst cannot pile up waiting for pool connections.
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+
+    def try_acquire(self):
+        if self.limit and self.in_flight >= self.limit:
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+
+
+async def send_error(send, status_code: int, detail: str, retry_after: float):
+    body = orjson.dumps({ "detail" : detail })
+    await send({
+        "type" : "http.response.start",
+        "status" : status_code,
+        "headers" : [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+        ],
+    })
+    await send({ "type" : "http.response.body", "body" : body })
+
+
+class AdmissionMiddleware:
+    def __init__(self, app, limiter: ConcurrencyLimiter, exempt_paths=()):
+        self.app = app
+        self.limiter = limiter
+        self.exempt_paths = set(exempt_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.exempt_paths:
+            await self.app(scope, receive, send)
+            return
+        if not self.limiter.try_acquire():
+            await send_error(send, 503, "Server is busy, please retry", 1)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.limiter.release()
+
+
+class RateLimitMiddleware:
+    # Login paths are limited per client IP. Writes are limited per user,
+    # or per IP when the request carries no valid token; identify_user maps
+    # a bearer token to a user name, or None.
+
+    def __init__(
+        self,
+        app,
+        backend,
+        login_rate: Rate,
+        write_rate: Rate,
+        identify_user,
+        login_paths=("/token", "/token/refresh"),
+        trust_forwarded_for: bool = False
+    ):
+        self.app = app
+        self.backend = backend
+        self.login_rate = login_rate
+        self.write_rate = write_rate
+        self.identify_user = identify_user
+        self.login_paths = set(login_paths)
+        self.trust_forwarded_for = trust_forwarded_for
+
+    def client_ip(self, scope):
+        if self.trust_forwarded_for:
+            for name, value in scope["headers"]:
+                if name == b"x-forwarded-for":
+                    return value.decode("latin-1").split(",")[0].strip()
+        client = scope.get("client")
+        return client[0] if client else "unknown"
+
+    def bucket(self, scope):
+        if scope["path"] in self.login_paths:
+            return "login:" + self.client_ip(scope), self.login_rate
+        if scope["method"] not in WRITE_METHODS:
+            return None, None
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                scheme, _, token = value.decode("latin-1").partition(" ")
+                user = self.identify_user(token) if scheme.lower() == "bearer" else None
+                if user is not None:
+                    return "write:user:" + user, self.write_rate
+        return "write:ip:" + self.client_ip(scope), self.write_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        key, rate = self.bucket(scope)
+        if key is not None and rate.per_second > 0:
+            if self.backend.blocking:
+                retry_after = await anyio.to_thread.run_sync(self.backend.acquire, key, rate)
+            else:
+                retry_after = self.backend.acquire(key, rate)
+            if retry_after:
+                await send_error(send, 429, "Too many requests", retry_after)
+                return
+        await self.app(scope, receive, send)
@@ -0,0 +1,208 @@
+"""Production entry point: a preforking uvicorn server.
+
+    python -m app.serve [--workers N] [--host HOST] [--port PORT]
+    python -m app.serve --import-report
+
+The parent imports app.main once, binds the socket and forks the workers,
+so every worker starts with the application already loaded. Database
+engines are only created inside the workers (see sql.database). uvloop
+and httptools are used when they are installed. A worker that dies is
+replaced, unless it died while starting up.
+"""
+import argparse
+import importlib.util
+import logging
+import math
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import uvicorn
+
+from app import config
+
+logger = logging.getLogger("app.serve")
+
+# A worker exiting sooner than this after the fork is treated as a startup
+# failure, and the server shuts down instead of forking it again.
+STARTUP_GRACE_SECONDS = 5.0
+
+
+def cgroup_cpu_limit(path="/sys/fs/cgroup/cpu.max"):
+    # cgroup v2 quota, e.g. "200000 100000" for two CPUs; "max" is no limit.
+    try:
+        with open(path) as f:
+            quota, period = f.read().split()[:2]
+    except (OSError, ValueError):
+        return None
+    if quota == "max":
+        return None
+    return int(quota) / int(period)
+
+def available_cpus():
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, max(1, math.ceil(limit)))
+    return cpus
+
+def worker_count(requested: int = 0, cpus: int = None):
+    if requested > 0:
+        return requested
+    return cpus if cpus is not None else available_cpus()
+
+def event_loop():
+    return "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+
+def http_protocol():
+    return "httptools" if importlib.util.find_spec("httptools") else "h11"
+
+def slowest_imports(importtime_output: str, top: int = 15):
+    # Parses `python -X importtime` output into (cumulative_us, self_us, module)
+    # tuples, slowest first.
+    rows = []
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|", 2)
+        if not self_us.strip().isdigit():
+            continue
+        rows.append((int(cumulative_us), int(self_us), module.strip()))
+    rows.sort(reverse=True)
+    return rows[:top]
+
+def import_report(module: str = "app.main", top: int = 15):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        capture_output=True, text=True, check=True
+    )
+    lines = ["{:>10} {:>10}  {}".format("total ms", "self ms", "module")]
+    for cumulative_us, self_us, name in slowest_imports(result.stderr, top):
+        lines.append("{:>10.1f} {:>10.1f}  {}".format(cumulative_us / 1000, self_us / 1000, name))
+    return "\n".join(lines)
+
+
+class WorkerServer(uvicorn.Server):
+    def __init__(self, config, forked_at):
+        super().__init__(config)
+        self.forked_at = forked_at
+
+    async def startup(self, sockets=None):
+        await super().startup(sockets=sockets)
+        if self.started:
+            logger.info("Worker %d ready in %.0f ms", os.getpid(), (time.perf_counter() - self.forked_at) * 1000)
+
+
+class Arbiter:
+    def __init__(self, server_config, workers: int):
+        self.config = server_config
+        self.workers = workers
+        self.children = {}
+        self.stopping = False
+        self.socket = None
+
+    def spawn(self):
+        forked_at = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            status = 1
+            try:
+                server = WorkerServer(self.config, forked_at)
+                server.run(sockets=[self.socket])
+                status = 0 if server.started else 1
+            except BaseException:
+                logger.exception("Worker %d crashed", os.getpid())
+            finally:
+                os._exit(status)
+        self.children[pid] = time.monotonic()
+        if self.stopping:
+            # The stop signal arrived while forking, before the pid was known
+            os.kill(pid, signal.SIGTERM)
+        return pid
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        self.socket = self.config.bind_socket()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for _ in range(self.workers):
+            self.spawn()
+
+        exit_code = 0
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            started_at = self.children.pop(pid, None)
+            if started_at is None or self.stopping:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            if time.monotonic() - started_at < STARTUP_GRACE_SECONDS:
+                logger.error("Worker %d exited with %d while starting, shutting down", pid, code)
+                exit_code = 1
+                self.stop(None, None)
+                continue
+            logger.warning("Worker %d exited with %d, starting a new one", pid, code)
+            self.spawn()
+        self.socket.close()
+        return exit_code
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=config.WEB_CONCURRENCY)
+    parser.add_argument("--host", default=config.HOST)
+    parser.add_argument("--port", type=int, default=config.PORT)
+    parser.add_argument("--import-report", action="store_true", help="print the slowest imports of app.main and exit")
+    args = parser.parse_args(argv)
+
+    if args.import_report:
+        print(import_report())
+        return 0
+
+    # Formatted like uvicorn's own lines, which do not go through the root logger.
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(levelname)s:     %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    started = time.perf_counter()
+    loaded_modules = len(sys.modules)
+    from app.main import app
+
+    server_config = uvicorn.Config(
+        app,
+        host=args.host,
+        port=args.port,
+        loop=event_loop(),
+        http=http_protocol(),
+        proxy_headers=True,
+    )
+    workers = worker_count(args.workers)
+    logger.info(
+        "Loaded app.main in %.0f ms (%d modules); %d workers, %s loop, %s parser",
+        (time.perf_counter() - started) * 1000, len(sys.modules) - loaded_modules,
+        workers, server_config.loop, server_config.http
+    )
+    return Arbiter(server_config, workers).run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,54 @@
+import gzip
+
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi.testclient import TestClient
+
+from . import compression
+from .compression import CompressionMiddleware, accepted_encodings
+
+app = FastAPI()
+app.add_middleware(CompressionMiddleware, minimum_size=100)
+
+@app.get("/large")
+def large():
+    return PlainTextResponse("x" * 1000)
+
+@app.get("/small")
+def small():
+    return PlainTextResponse("x")
+
+@app.get("/stream")
+def stream():
+    return StreamingResponse(iter([b"x" * 1000, b"y" * 1000]), media_type="text/plain")
+
+client = TestClient(app)
+
+
+def test_accepted_encodings():
+    assert accepted_encodings("gzip, br;q=0, deflate;q=0.5") == { "gzip", "deflate" }
+
+def test_gzip_above_minimum_size():
+    response = client.get("/large", headers={ "Accept-Encoding" : "gzip" })
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert response.text == "x" * 1000
+
+def test_small_response_is_not_compressed():
+    response = client.get("/small", headers={ "Accept-Encoding" : "gzip" })
+    assert "content-encoding" not in response.headers
+    assert response.text == "x"
+
+def test_streaming_response_is_compressed():
+    response = client.get("/stream", headers={ "Accept-Encoding" : "gzip" }, stream=True)
+    assert response.headers["content-encoding"] == "gzip"
+    assert "content-length" not in response.headers
+    assert gzip.decompress(b"".join(response.raw.stream(decode_content=False))) == b"x" * 1000 + b"y" * 1000
+
+def test_brotli_preferred_when_installed():
+    if compression.brotli is None:
+        pytest.skip("brotli is not installed")
+    response = client.get("/large", headers={ "Accept-Encoding" : "gzip, br" }, stream=True)
+    assert response.headers["content-encoding"] == "br"
+    assert compression.brotli.decompress(b"".join(response.raw.stream(decode_content=False))) == b"x" * 1000
@@ -0,0 +1,23 @@
+import pytest
+
+from .config import parse_keys
+
+
+def test_keys_with_kids():
+    assert parse_keys("new:secret-a, old:secret:b") == { "new" : "secret-a", "old" : "secret:b" }
+
+def test_bare_secret_gets_default_kid():
+    assert parse_keys("supersecretvalue") == { "default" : "supersecretvalue" }
+
+@pytest.mark.parametrize("value", ["new:,old:secret", "new:secret,oldsecret", ":secret", "kid:"])
+def test_malformed_keys_are_rejected(value):
+    with pytest.raises(ValueError):
+        parse_keys(value)
+
+def test_admission_limit_defaults_to_pool_capacity(monkeypatch):
+    import importlib
+
+    from . import config
+
+    monkeypatch.delenv("ADMISSION_MAX_CONCURRENT", raising=False)
+    assert importlib.reload(config).ADMISSION_MAX_CONCURRENT == config.DB_POOL_SIZE + config.DB_MAX_OVERFLOW
@@ -0,0 +1,49 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from .consistency import COOKIE, ReadYourWrites, ReadYourWritesMiddleware
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_writer_reads_primary_during_window():
+    timer = FakeTimer()
+    tracker = ReadYourWrites(window=5, timer=timer)
+    until = tracker.record("alice")
+
+    assert tracker.wrote_recently("alice")
+    assert not tracker.wrote_recently("bob")
+    assert tracker.wrote_recently(None, str(until))
+    assert not tracker.wrote_recently(None, "not a number")
+
+    timer.now += 5
+    assert not tracker.wrote_recently("alice", str(until))
+
+def test_middleware_sets_cookie_on_successful_writes():
+    app = FastAPI()
+    tracker = ReadYourWrites(window=5)
+    app.add_middleware(ReadYourWritesMiddleware, tracker=tracker, identify_user=lambda token: token or None)
+
+    @app.post("/things")
+    def create_thing():
+        return {}
+
+    @app.post("/token")
+    def login():
+        return {}
+
+    @app.get("/things")
+    def get_things():
+        return []
+
+    client = TestClient(app)
+    assert COOKIE not in client.get("/things").cookies
+    assert COOKIE not in client.post("/token").cookies
+    assert COOKIE in client.post("/things", headers={ "Authorization" : "Bearer alice" }).cookies
+    assert tracker.wrote_recently("alice")
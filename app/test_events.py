@@ -0,0 +1,36 @@
+import asyncio
+
+from .events import RESYNC, TaskEventBroker
+
+
+def test_events_reach_user_and_project_subscribers():
+    async def scenario():
+        broker = TaskEventBroker(queue_size=10)
+        with broker.subscribe(("user", 1)) as user_queue, broker.subscribe(("project", 7)) as project_queue:
+            broker.publish({ "type" : "task.created", "user_id" : 1, "project_id" : 7 })
+            broker.publish({ "type" : "task.created", "user_id" : 2, "project_id" : 8 })
+            assert user_queue.qsize() == 1
+            assert project_queue.qsize() == 1
+        assert broker.subscriber_count() == 0
+
+    asyncio.run(scenario())
+
+def test_slow_subscriber_gets_resync():
+    async def scenario():
+        broker = TaskEventBroker(queue_size=2)
+        with broker.subscribe(("user", 1)) as queue:
+            for _ in range(3):
+                broker.publish({ "type" : "task.created", "user_id" : 1, "project_id" : 7 })
+            assert queue.get_nowait() == RESYNC
+            assert queue.empty()
+
+    asyncio.run(scenario())
+
+def test_publish_threadsafe_without_event_resyncs_everyone():
+    async def scenario():
+        broker = TaskEventBroker(queue_size=10)
+        with broker.subscribe(("project", 3)) as queue:
+            broker.publish_threadsafe(None)
+            assert await asyncio.wait_for(queue.get(), 1) == RESYNC
+
+    asyncio.run(scenario())
@@ -0,0 +1,31 @@
+import asyncio
+import threading
+
+import pytest
+
+from .hashing import HashingPool, PoolSaturated
+
+
+def test_runs_job_off_the_loop():
+    pool = HashingPool(max_workers=1, max_pending=0)
+
+    async def run():
+        return await pool.run(threading.current_thread)
+
+    assert asyncio.run(run()) is not threading.main_thread()
+
+def test_rejects_when_saturated():
+    pool = HashingPool(max_workers=1, max_pending=0)
+    release = threading.Event()
+
+    async def run():
+        busy = asyncio.ensure_future(pool.run(release.wait))
+        await asyncio.sleep(0)
+        with pytest.raises(PoolSaturated):
+            await pool.run(lambda: None)
+        release.set()
+        await busy
+        # the slot is free again once the first job has finished
+        assert await pool.run(lambda: 42) == 42
+
+    asyncio.run(run())
@@ -0,0 +1,40 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+
+from .metrics import Histogram, MetricsMiddleware, instrument_queries, request_duration, request_queries
+
+engine = create_engine("sqlite://")
+instrument_queries(0)
+
+app = FastAPI()
+app.add_middleware(MetricsMiddleware)
+
+@app.get("/items/{item_id}")
+def get_item(item_id: int):
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+        connection.execute(text("SELECT 2"))
+    return { "id" : item_id }
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("latency", "Latency", ("route",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, "/a")
+    histogram.observe(0.5, "/a")
+    histogram.observe(5, "/a")
+    lines = histogram.render()
+    assert 'latency_bucket{route="/a",le="0.1"} 1' in lines
+    assert 'latency_bucket{route="/a",le="1.0"} 2' in lines
+    assert 'latency_bucket{route="/a",le="+Inf"} 3' in lines
+    assert 'latency_count{route="/a"} 3' in lines
+
+def test_requests_are_labelled_by_route_and_count_queries():
+    client = TestClient(app)
+    before = request_queries.count("/items/{item_id}")
+    client.get("/items/1")
+    client.get("/items/2")
+
+    assert request_duration.count("GET", "/items/{item_id}", 200) >= 2
+    assert request_queries.count("/items/{item_id}") == before + 2
+    assert any(line.startswith('http_request_db_queries_sum{route="/items/{item_id}"} 4') for line in request_queries.render())
@@ -0,0 +1,87 @@
+import asyncio
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from .ratelimit import AdmissionMiddleware, ConcurrencyLimiter, MemoryBackend, Rate, RateLimitMiddleware
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_bucket_refills_over_time():
+    timer = FakeTimer()
+    backend = MemoryBackend(timer=timer)
+    rate = Rate(capacity=2, per_second=1)
+    assert backend.acquire("k", rate) == 0
+    assert backend.acquire("k", rate) == 0
+    assert backend.acquire("k", rate) == 1
+
+    timer.now = 1
+    assert backend.acquire("k", rate) == 0
+    assert backend.acquire("other", rate) == 0
+
+def test_least_recently_used_buckets_are_dropped():
+    backend = MemoryBackend(max_keys=1)
+    rate = Rate(capacity=1, per_second=0.001)
+    backend.acquire("a", rate)
+    backend.acquire("b", rate)
+    assert backend.acquire("a", rate) == 0
+
+def make_app(limiter=None):
+    app = FastAPI()
+
+    @app.post("/token")
+    def login():
+        return {}
+
+    @app.post("/tasks")
+    def write():
+        return {}
+
+    @app.get("/tasks")
+    async def read():
+        await asyncio.sleep(0)
+        return {}
+
+    app.add_middleware(
+        RateLimitMiddleware,
+        backend=MemoryBackend(),
+        login_rate=Rate(2, 0.01),
+        write_rate=Rate(1, 0.01),
+        identify_user=lambda token: token or None
+    )
+    if limiter is not None:
+        app.add_middleware(AdmissionMiddleware, limiter=limiter)
+    return app
+
+def test_login_is_limited_per_ip():
+    client = TestClient(make_app())
+    assert client.post("/token").status_code == 200
+    assert client.post("/token").status_code == 200
+    response = client.post("/token")
+    assert response.status_code == 429
+    assert int(response.headers["retry-after"]) >= 1
+
+def test_writes_are_limited_per_user_and_reads_are_not():
+    client = TestClient(make_app())
+    assert client.post("/tasks", headers={ "Authorization" : "Bearer alice" }).status_code == 200
+    assert client.post("/tasks", headers={ "Authorization" : "Bearer alice" }).status_code == 429
+    assert client.post("/tasks", headers={ "Authorization" : "Bearer bob" }).status_code == 200
+    assert client.get("/tasks", headers={ "Authorization" : "Bearer alice" }).status_code == 200
+
+def test_requests_over_the_concurrency_limit_are_shed():
+    limiter = ConcurrencyLimiter(1)
+    client = TestClient(make_app(limiter))
+    assert client.get("/tasks").status_code == 200
+    assert limiter.in_flight == 0
+
+    limiter.in_flight = 1
+    response = client.get("/tasks")
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "1"
@@ -0,0 +1,31 @@
+from sql import database
+
+from .serve import cgroup_cpu_limit, slowest_imports, worker_count
+
+IMPORTTIME = """import time: self [us] | cumulative | imported package
+import time:       120 |        120 |   _io
+import time:       300 |       5000 |     fastapi
+import time:      2000 |      40000 | app.main
+"""
+
+
+def test_worker_count():
+    assert worker_count(3, cpus=8) == 3
+    assert worker_count(0, cpus=8) == 8
+
+def test_cgroup_cpu_limit(tmp_path):
+    path = tmp_path / "cpu.max"
+    path.write_text("150000 100000\n")
+    assert cgroup_cpu_limit(str(path)) == 1.5
+
+    path.write_text("max 100000\n")
+    assert cgroup_cpu_limit(str(path)) is None
+    assert cgroup_cpu_limit(str(tmp_path / "missing")) is None
+
+def test_slowest_imports():
+    assert slowest_imports(IMPORTTIME, top=2) == [(40000, 2000, "app.main"), (5000, 300, "fastapi")]
+
+def test_forked_child_gets_its_own_engine():
+    engine = database.get_engine()
+    database._forget_engines()
+    assert database.get_engine() is not engine
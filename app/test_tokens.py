@@ -0,0 +1,46 @@
+import time
+from datetime import timedelta
+
+import pytest
+from jose import JWTError
+
+from .cache import TTLCache
+from .tokens import REFRESH, TokenService
+
+
+def make_service(keys, timer=time.time):
+    return TokenService(keys, "HS256", TTLCache(maxsize=100, ttl=60), timer=timer)
+
+def test_round_trip_and_cache():
+    service = make_service({ "new" : "secret" })
+    token = service.encode({ "sub" : "someone" }, timedelta(minutes=5))
+    assert service.decode(token)["sub"] == "someone"
+    assert service.decode(token)["sub"] == "someone"
+
+def test_rotated_key_still_accepted():
+    old = make_service({ "old" : "old-secret" })
+    token = old.encode({ "sub" : "someone" }, timedelta(minutes=5))
+
+    rotated = make_service({ "new" : "new-secret", "old" : "old-secret" })
+    assert rotated.decode(token)["sub"] == "someone"
+
+    retired = make_service({ "new" : "new-secret" })
+    with pytest.raises(JWTError):
+        retired.decode(token)
+
+def test_cached_claims_expire_with_the_token():
+    now = [time.time()]
+    service = make_service({ "k" : "secret" }, timer=lambda: now[0])
+    token = service.encode({ "sub" : "someone" }, timedelta(seconds=30))
+    service.decode(token)
+
+    now[0] += 31
+    with pytest.raises(JWTError):
+        service.decode(token)
+
+def test_refresh_token_is_not_an_access_token():
+    service = make_service({ "k" : "secret" })
+    token = service.encode({ "sub" : "someone" }, timedelta(days=1), REFRESH)
+    with pytest.raises(JWTError):
+        service.decode(token)
+    assert service.decode(token, REFRESH)["sub"] == "someone"
@@ -0,0 +1,70 @@
+import asyncio
+import contextlib
+
+import pytest
+
+from .writebehind import GroupCommitQueue, QueueFull
+
+
+@contextlib.asynccontextmanager
+async def open_session():
+    yield None
+
+
+def test_concurrent_submits_share_a_batch():
+    batches = []
+
+    async def write_batch(db, entries):
+        batches.append(entries)
+        return [entry * 10 for entry in entries]
+
+    async def scenario():
+        queue = GroupCommitQueue(open_session, write_batch, max_rows=3, interval=0.05, max_pending=10)
+        results = await asyncio.gather(*(queue.submit(i) for i in range(5)))
+        await queue.stop()
+        return results
+
+    assert asyncio.run(scenario()) == [0, 10, 20, 30, 40]
+    assert batches == [[0, 1, 2], [3, 4]]
+
+def test_entry_errors_go_to_their_own_caller():
+    async def write_batch(db, entries):
+        return [ValueError(entry) if entry == "bad" else entry for entry in entries]
+
+    async def scenario():
+        queue = GroupCommitQueue(open_session, write_batch, max_rows=10, interval=0.001, max_pending=10)
+        results = await asyncio.gather(queue.submit("good"), queue.submit("bad"), return_exceptions=True)
+        await queue.stop()
+        return results
+
+    good, bad = asyncio.run(scenario())
+    assert good == "good"
+    assert isinstance(bad, ValueError)
+
+def test_failed_batch_fails_every_entry():
+    async def write_batch(db, entries):
+        raise RuntimeError("database went away")
+
+    async def scenario():
+        queue = GroupCommitQueue(open_session, write_batch, max_rows=10, interval=0.001, max_pending=10)
+        results = await asyncio.gather(queue.submit(1), queue.submit(2), return_exceptions=True)
+        await queue.stop()
+        return results
+
+    assert all(isinstance(result, RuntimeError) for result in asyncio.run(scenario()))
+
+def test_submit_rejected_when_queue_is_full():
+    async def write_batch(db, entries):
+        return entries
+
+    async def scenario():
+        queue = GroupCommitQueue(open_session, write_batch, max_rows=10, interval=1, max_pending=1)
+        first = asyncio.ensure_future(queue.submit(1))
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFull):
+            await queue.submit(2)
+        # stop() commits what is still waiting
+        await queue.stop()
+        return await first
+
+    assert asyncio.run(scenario()) == 1
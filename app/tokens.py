@@ -0,0 +1,64 @@
+import hashlib
+import time
+from datetime import datetime, timedelta
+
+from jose import JWTError, jwt
+
+from app.cache import TTLCache
+
+ACCESS = "access"
+REFRESH = "refresh"
+
+
+class TokenService:
+    # Signs and checks JWTs with a set of HMAC keys picked by the "kid"
+    # header. The first key signs; the others are only accepted, which lets
+    # a new key be rolled out before the old one is dropped. Decoded claims
+    # are cached by token digest until the token expires, so repeated
+    # requests skip the signature check.
+
+    def __init__(self, keys: dict, algorithm: str, cache: TTLCache, timer=time.time):
+        if not keys:
+            raise ValueError("At least one signing key is required")
+        self._keys = keys
+        self._signing_kid = next(iter(keys))
+        self._algorithm = algorithm
+        self._cache = cache
+        self._timer = timer
+
+    def encode(self, claims: dict, expires_delta: timedelta, token_type: str = ACCESS):
+        to_encode = dict(claims, exp=datetime.utcnow() + expires_delta)
+        if token_type != ACCESS:
+            to_encode["typ"] = token_type
+        return jwt.encode(
+            to_encode,
+            self._keys[self._signing_kid],
+            algorithm=self._algorithm,
+            headers={ "kid" : self._signing_kid }
+        )
+
+    def decode(self, token: str, token_type: str = ACCESS):
+        # Raises JWTError for a bad signature, an unknown key, an expired
+        # token or a token of the wrong type.
+        digest = hashlib.sha256(token.encode()).digest()
+        cached = self._cache.get(digest)
+        if cached is not None:
+            kid, claims = cached
+            if kid not in self._keys or claims["exp"] <= self._timer():
+                self._cache.pop(digest)
+                raise JWTError("Token is no longer valid")
+        else:
+            kid = jwt.get_unverified_header(token).get("kid", self._signing_kid)
+            if kid not in self._keys:
+                raise JWTError("Unknown signing key")
+            claims = jwt.decode(token, self._keys[kid], algorithms=[self._algorithm])
+            if "exp" not in claims:
+                raise JWTError("Token has no expiry")
+            self._cache.set(digest, (kid, claims))
+
+        if claims.get("typ", ACCESS) != token_type:
+            raise JWTError("Wrong token type")
+        return claims
+
+    def clear(self):
+        self._cache.clear()
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class GroupCommitQueue:
+    # Collects writes from concurrent requests and commits them together:
+    # a batch goes out once max_rows are waiting, or after waiting interval
+    # seconds for more, and the next batch gathers while it commits.
+    # write_batch(db, entries) returns one result per entry, either a value
+    # or an exception for that entry. Callers wait for their own result, so
+    # a response is only sent after its commit.
+
+    def __init__(self, open_session, write_batch, max_rows: int, interval: float, max_pending: int):
+        self._open_session = open_session
+        self._write_batch = write_batch
+        self._max_rows = max_rows
+        self._interval = interval
+        self._max_pending = max_pending
+        self._pending = []
+        self._wake = None
+        self._full = None
+        self._task = None
+        self._stopping = False
+
+    def __len__(self):
+        return len(self._pending)
+
+    def start(self):
+        # Also called on the first submit, inside the loop that serves requests
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._full = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        # Lets a running flush finish and commits everything still waiting
+        if self._task is not None:
+            self._stopping = True
+            self._wake.set()
+            self._full.set()
+            try:
+                await self._task
+            finally:
+                self._task = None
+                self._stopping = False
+
+    async def submit(self, entry):
+        if len(self._pending) >= self._max_pending:
+            raise QueueFull()
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((entry, future))
+        self._wake.set()
+        if len(self._pending) >= self._max_rows:
+            self._full.set()
+        return await future
+
+    async def flush(self):
+        batch, self._pending = self._pending[:self._max_rows], self._pending[self._max_rows:]
+        if len(self._pending) < self._max_rows:
+            self._full.clear()
+        # Entries whose request went away before the flush are not written
+        batch = [(entry, future) for entry, future in batch if not future.done()]
+        if not batch:
+            return
+
+        try:
+            async with self._open_session() as db:
+                results = await self._write_batch(db, [entry for entry, _ in batch])
+        except Exception as e:
+            logger.exception("Group commit of %d entries failed", len(batch))
+            results = [e] * len(batch)
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _run(self):
+        while True:
+            await self._wake.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), self._interval)
+            except asyncio.TimeoutError:
+                pass
+            if self._pending:
+                await self.flush()
+            if not self._pending:
+                if self._stopping:
+                    return
+                self._wake.clear()
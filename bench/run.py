@@ -0,0 +1,212 @@
+"""Load-test the API hot paths and print the results as JSON.
+
+Start the server against a seeded database (see bench.seed), with the rate
+limits off so the token and write scenarios measure the routes rather than
+the limiter (RATE_LIMIT_LOGIN_PER_MINUTE=0 RATE_LIMIT_WRITES_PER_SECOND=0),
+then:
+
+    python -m bench.run --base-url http://localhost:8000 --concurrency 16 \
+        --requests 2000 --output results.json
+
+Each scenario runs on its own with --concurrency threads, one keep-alive
+session per thread. Latencies are wall-clock per request and only cover
+successful responses; rejected ones (e.g. 503 from /token under load) are
+counted per status code. Compare the JSON files of two commits to spot
+regressions.
+"""
+import argparse
+import json
+import platform
+import subprocess
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import requests
+
+SCENARIOS = ("token", "get_tasks", "post_task", "patch_task", "get_users")
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, statuses, elapsed):
+    latencies.sort()
+    to_ms = lambda value: None if value is None else round(value * 1000, 3)
+    errors = sum(count for status, count in statuses.items() if status == "error" or int(status) >= 400)
+    return {
+        "requests" : sum(statuses.values()),
+        "errors" : errors,
+        "status_codes" : dict(sorted(statuses.items())),
+        "throughput_rps" : round(len(latencies) / elapsed, 2) if elapsed else None,
+        "mean_ms" : to_ms(sum(latencies) / len(latencies)) if latencies else None,
+        "p50_ms" : to_ms(percentile(latencies, 0.50)),
+        "p90_ms" : to_ms(percentile(latencies, 0.90)),
+        "p99_ms" : to_ms(percentile(latencies, 0.99)),
+        "max_ms" : to_ms(latencies[-1]) if latencies else None,
+    }
+
+
+class Client:
+    def __init__(self, base_url, user_name, password):
+        self.base_url = base_url.rstrip("/")
+        self.user_name = user_name
+        self.password = password
+        self.session = requests.Session()
+        self.headers = {}
+        self.task_id = None
+
+    def url(self, path):
+        return self.base_url + path
+
+    def send(self, method, path, attempts=20, **kwargs):
+        # For setup requests: the server sheds password hashing load with
+        # 503, and the rate limiter answers 429, both with Retry-After.
+        for _ in range(attempts):
+            response = self.session.request(method, self.url(path), **kwargs)
+            if response.status_code not in (429, 503):
+                break
+            time.sleep(min(float(response.headers.get("Retry-After", 0.1)), 5))
+        response.raise_for_status()
+        return response
+
+    def login(self):
+        response = self.send("POST", "/token", data={ "username" : self.user_name, "password" : self.password })
+        self.headers = { "Authorization" : "Bearer " + response.json()["access_token"] }
+        return response
+
+    def task_body(self, description):
+        return {
+            "project_id" : self.project_id,
+            "start_time" : "09:00",
+            "end_time" : "10:00",
+            "task_date" : datetime.now().date().isoformat(),
+            "duration" : 1,
+            "description" : description
+        }
+
+    def prepare(self, project_id):
+        self.project_id = project_id
+        self.login()
+        response = self.send("POST", "/tasks", json=self.task_body("benchmark patch target"), headers=self.headers)
+        self.task_id = response.json()["id"]
+
+    def request(self, scenario, sequence):
+        if scenario == "token":
+            return self.session.post(self.url("/token"), data={ "username" : self.user_name, "password" : self.password })
+        if scenario == "get_tasks":
+            return self.session.get(self.url("/tasks"), headers=self.headers)
+        if scenario == "post_task":
+            return self.session.post(self.url("/tasks"), json=self.task_body("benchmark task"), headers=self.headers)
+        if scenario == "patch_task":
+            return self.session.patch(
+                self.url("/tasks/{}".format(self.task_id)),
+                json=self.task_body("benchmark patch {}".format(sequence)),
+                headers=self.headers
+            )
+        if scenario == "get_users":
+            return self.session.get(self.url("/users"))
+        raise ValueError(scenario)
+
+
+def run_scenario(clients, scenario, total_requests, warmup):
+    lock = threading.Lock()
+    latencies = []
+    statuses = Counter()
+    counter = iter(range(total_requests + warmup))
+
+    def worker(client):
+        while True:
+            with lock:
+                sequence = next(counter, None)
+            if sequence is None:
+                return
+            started = time.perf_counter()
+            try:
+                status = str(client.request(scenario, sequence).status_code)
+            except requests.RequestException:
+                status = "error"
+            elapsed = time.perf_counter() - started
+            if sequence < warmup:
+                continue
+            with lock:
+                statuses[status] += 1
+                if status != "error" and int(status) < 400:
+                    latencies.append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+        list(executor.map(worker, clients))
+    return summarize(latencies, statuses, time.perf_counter() - started)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=1000, help="measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=50, help="unmeasured requests per scenario")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated, from: " + ", ".join(SCENARIOS))
+    parser.add_argument("--users", type=int, default=20, help="how many seeded users to spread the load over")
+    parser.add_argument("--project-id", type=int, help="project used for created tasks (default: the first seeded one)")
+    parser.add_argument("--password", default="bench-password")
+    parser.add_argument("--prefix", default="bench")
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error("unknown scenarios: " + ", ".join(sorted(unknown)))
+
+    if args.project_id is None:
+        projects = requests.get(args.base_url.rstrip("/") + "/projects").json()
+        seeded = [p["id"] for p in projects if p["name"].startswith(args.prefix + "_project_")]
+        if not seeded:
+            parser.error("no seeded projects found, run bench.seed first or pass --project-id")
+        args.project_id = min(seeded)
+
+    clients = [
+        Client(args.base_url, "{}_user_{}".format(args.prefix, i % args.users), args.password)
+        for i in range(args.concurrency)
+    ]
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(lambda client: client.prepare(args.project_id), clients))
+
+    results = {
+        "timestamp" : datetime.now(timezone.utc).isoformat(),
+        "git_revision" : git_revision(),
+        "python" : platform.python_version(),
+        "base_url" : args.base_url,
+        "concurrency" : args.concurrency,
+        "requests" : args.requests,
+        "warmup" : args.warmup,
+        "scenarios" : {
+            scenario : run_scenario(clients, scenario, args.requests, args.warmup)
+            for scenario in scenarios
+        }
+    }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Seed the database with benchmark users, projects and tasks.
+
+    python -m bench.seed --users 50 --projects 20 --tasks-per-user 2000 --reset
+
+Uses DATABASE_URL like the application. Every benchmark user gets the
+password from --password (default "bench-password").
+"""
+import argparse
+import random
+import time
+from datetime import date, timedelta
+
+from sqlalchemy import delete, insert, select
+
+from sql import crud, models
+from sql.database import engine
+
+CHUNK_SIZE = 5000
+
+
+def reset(connection, prefix):
+    user_ids = select(models.User.id).where(models.User.user_name.like(prefix + "_user_%"))
+    project_ids = select(models.Project.id).where(models.Project.name.like(prefix + "_project_%"))
+    connection.execute(delete(models.Task).where(models.Task.user_id.in_(user_ids)))
+    connection.execute(delete(models.Task).where(models.Task.project_id.in_(project_ids)))
+    connection.execute(delete(models.User).where(models.User.id.in_(user_ids)))
+    connection.execute(delete(models.Project).where(models.Project.id.in_(project_ids)))
+
+
+def seed(users, projects, tasks_per_user, password, prefix, seed_value):
+    rng = random.Random(seed_value)
+    # One hash shared by every user: hashing thousands of bcrypt passwords
+    # would dominate the seeding time.
+    hashed_password = crud.get_password_hash(password)
+
+    with engine.begin() as connection:
+        user_ids = [row.id for row in connection.execute(
+            insert(models.User.__table__).values([
+                { "user_name" : "{}_user_{}".format(prefix, i), "email" : "{}_user_{}@example.com".format(prefix, i), "password" : hashed_password }
+                for i in range(users)
+            ]).returning(models.User.id)
+        )] if users else []
+        project_ids = [row.id for row in connection.execute(
+            insert(models.Project.__table__).values([
+                { "name" : "{}_project_{}".format(prefix, i) } for i in range(projects)
+            ]).returning(models.Project.id)
+        )] if projects else []
+
+        start_date = date.today() - timedelta(days=3 * 365)
+        rows = []
+        for user_id in user_ids:
+            for _ in range(tasks_per_user):
+                start_hour = rng.randint(7, 18)
+                rows.append({
+                    "user_id" : user_id,
+                    "project_id" : rng.choice(project_ids),
+                    "start_time" : "{:02d}:00".format(start_hour),
+                    "end_time" : "{:02d}:00".format(start_hour + 1),
+                    "task_date" : start_date + timedelta(days=rng.randint(0, 3 * 365)),
+                    "duration" : 1,
+                    "description" : "benchmark task"
+                })
+                if len(rows) >= CHUNK_SIZE:
+                    connection.execute(insert(models.Task.__table__), rows)
+                    rows = []
+        if rows:
+            connection.execute(insert(models.Task.__table__), rows)
+
+    return len(user_ids), len(project_ids), len(user_ids) * tasks_per_user
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--projects", type=int, default=10)
+    parser.add_argument("--tasks-per-user", type=int, default=1000)
+    parser.add_argument("--password", default="bench-password")
+    parser.add_argument("--prefix", default="bench")
+    parser.add_argument("--seed", type=int, default=1, help="random seed, for reproducible data")
+    parser.add_argument("--reset", action="store_true", help="delete earlier benchmark rows first")
+    args = parser.parse_args(argv)
+
+    if args.projects < 1 and args.tasks_per_user > 0:
+        parser.error("--projects must be at least 1 when tasks are seeded")
+
+    started = time.perf_counter()
+    if args.reset:
+        with engine.begin() as connection:
+            reset(connection, args.prefix)
+    users, projects, tasks = seed(args.users, args.projects, args.tasks_per_user, args.password, args.prefix, args.seed)
+    print("seeded {} users, {} projects, {} tasks in {:.1f}s".format(users, projects, tasks, time.perf_counter() - started))
+
+
+if __name__ == "__main__":
+    main()
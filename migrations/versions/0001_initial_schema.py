@@ -0,0 +1,56 @@
+"""initial schema
+
+Existing databases already have these tables; mark them with
+`alembic stamp 0001` before running `alembic upgrade head`.
+
+Revision ID: 0001
+Revises:
+Create Date: 2022-09-20
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for sequence in ("projects_id_seq", "users_id_seq", "tasks_id_seq"):
+        op.execute(sa.schema.CreateSequence(sa.Sequence(sequence)))
+
+    op.create_table(
+        "projects",
+        sa.Column("id", sa.Integer, primary_key=True, server_default=sa.text("nextval('projects_id_seq'::regclass)")),
+        sa.Column("name", sa.String(255)),
+    )
+    op.create_table(
+        "users",
+        sa.Column("id", sa.Integer, primary_key=True, server_default=sa.text("nextval('users_id_seq'::regclass)")),
+        sa.Column("user_name", sa.String(255)),
+        sa.Column("password", sa.String(255)),
+        sa.Column("email", sa.String(255)),
+    )
+    op.create_table(
+        "tasks",
+        sa.Column("id", sa.Integer, primary_key=True, server_default=sa.text("nextval('tasks_id_seq'::regclass)")),
+        sa.Column("user_id", sa.Integer, sa.ForeignKey("users.id")),
+        sa.Column("project_id", sa.Integer, sa.ForeignKey("projects.id")),
+        sa.Column("start_time", sa.Time),
+        sa.Column("end_time", sa.Time),
+        sa.Column("task_date", sa.Date),
+        sa.Column("duration", sa.Integer),
+        sa.Column("description", sa.String(255)),
+    )
+
+    for table in ("projects", "users", "tasks"):
+        op.execute("ALTER SEQUENCE {0}_id_seq OWNED BY {0}.id".format(table))
+
+
+def downgrade():
+    op.drop_table("tasks")
+    op.drop_table("users")
+    op.drop_table("projects")
@@ -0,0 +1,39 @@
+"""indexes for task, user and project lookups
+
+Indexes are built CONCURRENTLY so the tables stay writable. The unique
+constraints fail if duplicate user or project names already exist; those
+have to be cleaned up first.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2022-09-20
+
+"""
+from alembic import op
+
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_tasks_user_id_task_date_id", "tasks", ["user_id", "task_date", "id"],
+            postgresql_concurrently=True
+        )
+        op.create_index("ix_tasks_project_id", "tasks", ["project_id"], postgresql_concurrently=True)
+        op.create_index("uq_users_user_name", "users", ["user_name"], unique=True, postgresql_concurrently=True)
+        op.create_index("uq_projects_name", "projects", ["name"], unique=True, postgresql_concurrently=True)
+
+    op.execute("ALTER TABLE users ADD CONSTRAINT uq_users_user_name UNIQUE USING INDEX uq_users_user_name")
+    op.execute("ALTER TABLE projects ADD CONSTRAINT uq_projects_name UNIQUE USING INDEX uq_projects_name")
+
+
+def downgrade():
+    op.drop_constraint("uq_projects_name", "projects", type_="unique")
+    op.drop_constraint("uq_users_user_name", "users", type_="unique")
+    op.drop_index("ix_tasks_project_id", table_name="tasks")
+    op.drop_index("ix_tasks_user_id_task_date_id", table_name="tasks")
@@ -0,0 +1,26 @@
+"""per-user tasks_version counter for the task list ETag
+
+Adding a column with a constant default does not rewrite the table on
+PostgreSQL 11+.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2022-09-27
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("users", sa.Column("tasks_version", sa.Integer(), nullable=False, server_default=sa.text("0")))
+
+
+def downgrade():
+    op.drop_column("users", "tasks_version")
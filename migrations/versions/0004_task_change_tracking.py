@@ -0,0 +1,46 @@
+"""task versions and tombstones for GET /tasks/changes
+
+Existing tasks keep version 0, so they are returned by a sync without
+`since` and skipped by incremental ones, which is what clients that
+already hold them expect.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2022-10-04
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("tasks", sa.Column("version", sa.Integer(), nullable=False, server_default=sa.text("0")))
+    op.create_table(
+        "task_tombstones",
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("task_id", sa.Integer(), nullable=False),
+        sa.Column("version", sa.Integer(), nullable=False),
+        sa.Column("deleted_at", sa.DateTime(timezone=True), server_default=sa.text("now()"), nullable=False),
+        sa.PrimaryKeyConstraint("user_id", "task_id")
+    )
+    op.create_index(
+        "ix_task_tombstones_user_id_version_task_id", "task_tombstones", ["user_id", "version", "task_id"]
+    )
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_tasks_user_id_version_id", "tasks", ["user_id", "version", "id"],
+            postgresql_concurrently=True
+        )
+
+
+def downgrade():
+    op.drop_index("ix_tasks_user_id_version_id", table_name="tasks")
+    op.drop_index("ix_task_tombstones_user_id_version_task_id", table_name="task_tombstones")
+    op.drop_table("task_tombstones")
+    op.drop_column("tasks", "version")
@@ -0,0 +1,46 @@
+"""ON DELETE CASCADE for tasks, deleted_at on users and projects
+
+The foreign keys are recreated NOT VALID and validated afterwards in a
+transaction of their own, so tasks is only locked briefly; validation
+does not block writes.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2022-10-11
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def replace_foreign_keys(ondelete):
+    op.drop_constraint("tasks_user_id_fkey", "tasks", type_="foreignkey")
+    op.drop_constraint("tasks_project_id_fkey", "tasks", type_="foreignkey")
+    op.create_foreign_key(
+        "tasks_user_id_fkey", "tasks", "users", ["user_id"], ["id"], ondelete=ondelete, postgresql_not_valid=True
+    )
+    op.create_foreign_key(
+        "tasks_project_id_fkey", "tasks", "projects", ["project_id"], ["id"], ondelete=ondelete, postgresql_not_valid=True
+    )
+    # Committing first releases the lock taken by the NOT VALID add.
+    with op.get_context().autocommit_block():
+        op.execute("ALTER TABLE tasks VALIDATE CONSTRAINT tasks_user_id_fkey")
+        op.execute("ALTER TABLE tasks VALIDATE CONSTRAINT tasks_project_id_fkey")
+
+
+def upgrade():
+    op.add_column("users", sa.Column("deleted_at", sa.DateTime(timezone=True)))
+    op.add_column("projects", sa.Column("deleted_at", sa.DateTime(timezone=True)))
+    replace_foreign_keys("CASCADE")
+
+
+def downgrade():
+    replace_foreign_keys(None)
+    op.drop_column("projects", "deleted_at")
+    op.drop_column("users", "deleted_at")
@@ -0,0 +1,32 @@
+"""rate_limit_buckets for the shared rate limiter backend
+
+UNLOGGED: the buckets are rewritten on every limited request and losing
+them in a crash only resets the limits.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2022-10-18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "rate_limit_buckets",
+        sa.Column("key", sa.String(255), primary_key=True),
+        sa.Column("tokens", sa.Float(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(timezone=True), nullable=False),
+        prefixes=["UNLOGGED"]
+    )
+
+
+def downgrade():
+    op.drop_table("rate_limit_buckets")
@@ -0,0 +1,44 @@
+"""generated tasks.time_range with a GiST index
+
+Adding a stored generated column rewrites tasks under an exclusive lock;
+run it in a quiet window on large installations. The index is built
+CONCURRENTLY. It covers time_range alone: a (user_id, time_range) GiST
+index would need btree_gist, which managed databases do not always
+offer, and the planner combines it with the user_id btree index instead.
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2022-10-25
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+TIME_RANGE_SQL = (
+    "CASE WHEN {d} IS NULL OR {s} IS NULL OR {e} IS NULL THEN NULL "
+    "ELSE tsrange({d} + {s}, {d} + {e} + CASE WHEN {e} < {s} THEN interval '1 day' ELSE interval '0' END, '[)') END"
+)
+
+
+def upgrade():
+    op.add_column("tasks", sa.Column(
+        "time_range",
+        postgresql.TSRANGE(),
+        sa.Computed(TIME_RANGE_SQL.format(d="task_date", s="start_time", e="end_time"), persisted=True)
+    ))
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_tasks_time_range", "tasks", ["time_range"], postgresql_using="gist", postgresql_concurrently=True
+        )
+
+
+def downgrade():
+    op.drop_index("ix_tasks_time_range", table_name="tasks")
+    op.drop_column("tasks", "time_range")
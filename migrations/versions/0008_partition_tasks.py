@@ -0,0 +1,101 @@
+"""partition tasks by RANGE (task_date)
+
+tasks is rebuilt as a partitioned table: one partition per month that has
+tasks, and a default partition. The application adds the partitions of
+the coming periods (see sql.partitions). The primary key becomes
+(id, task_date), so every task needs a task_date. Rows are copied into the new table, which locks tasks
+for the duration; plan a maintenance window on large installations.
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2022-11-01
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+revision = "0008"
+down_revision = "0007"
+branch_labels = None
+depends_on = None
+
+TIME_RANGE_SQL = (
+    "CASE WHEN {d} IS NULL OR {s} IS NULL OR {e} IS NULL THEN NULL "
+    "ELSE tsrange({d} + {s}, {d} + {e} + CASE WHEN {e} < {s} THEN interval '1 day' ELSE interval '0' END, '[)') END"
+)
+COLUMNS = "id, user_id, project_id, start_time, end_time, task_date, duration, description, version"
+# Fixed here rather than taken from sql.partitions, whose settings can change
+MONTHS = """
+    SELECT DISTINCT to_char(task_date, 'YYYY_MM') AS suffix,
+        date_trunc('month', task_date)::date AS first_day,
+        (date_trunc('month', task_date) + interval '1 month')::date AS next_first_day
+    FROM tasks_unpartitioned ORDER BY first_day
+"""
+
+
+def set_aside(name):
+    # Renames tasks out of the way. Index names are schema-wide, so its
+    # indexes go too, and the id sequence is kept from being dropped with it.
+    op.execute("ALTER SEQUENCE tasks_id_seq OWNED BY NONE")
+    op.execute("ALTER TABLE tasks RENAME TO {}".format(name))
+    op.execute("ALTER INDEX tasks_pkey RENAME TO {}_pkey".format(name))
+    for index in ("ix_tasks_user_id_task_date_id", "ix_tasks_project_id", "ix_tasks_user_id_version_id", "ix_tasks_time_range"):
+        op.drop_index(index, table_name=name)
+
+
+def create_tasks(partitioned):
+    op.create_table(
+        "tasks",
+        sa.Column("id", sa.Integer, nullable=False, server_default=sa.text("nextval('tasks_id_seq'::regclass)")),
+        sa.Column("user_id", sa.Integer, sa.ForeignKey("users.id", name="tasks_user_id_fkey", ondelete="CASCADE")),
+        sa.Column("project_id", sa.Integer, sa.ForeignKey("projects.id", name="tasks_project_id_fkey", ondelete="CASCADE")),
+        sa.Column("start_time", sa.Time),
+        sa.Column("end_time", sa.Time),
+        sa.Column("task_date", sa.Date, nullable=not partitioned),
+        sa.Column("duration", sa.Integer),
+        sa.Column("description", sa.String(255)),
+        sa.Column("version", sa.Integer, nullable=False, server_default=sa.text("0")),
+        sa.Column(
+            "time_range",
+            postgresql.TSRANGE(),
+            sa.Computed(TIME_RANGE_SQL.format(d="task_date", s="start_time", e="end_time"), persisted=True)
+        ),
+        sa.PrimaryKeyConstraint(*(("id", "task_date") if partitioned else ("id",)), name="tasks_pkey"),
+        **({ "postgresql_partition_by" : "RANGE (task_date)" } if partitioned else {})
+    )
+    op.execute("ALTER SEQUENCE tasks_id_seq OWNED BY tasks.id")
+
+
+def create_indexes():
+    op.create_index("ix_tasks_user_id_task_date_id", "tasks", ["user_id", "task_date", "id"])
+    op.create_index("ix_tasks_project_id", "tasks", ["project_id"])
+    op.create_index("ix_tasks_user_id_version_id", "tasks", ["user_id", "version", "id"])
+    op.create_index("ix_tasks_time_range", "tasks", ["time_range"], postgresql_using="gist")
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.execute(sa.text("SELECT EXISTS (SELECT 1 FROM tasks WHERE task_date IS NULL)")).scalar():
+        raise RuntimeError("Tasks without a task_date have to be fixed or removed before tasks can be partitioned")
+
+    set_aside("tasks_unpartitioned")
+    create_tasks(partitioned=True)
+    op.execute("CREATE TABLE tasks_default PARTITION OF tasks DEFAULT")
+    for suffix, start, end in bind.execute(sa.text(MONTHS)).all():
+        op.execute("CREATE TABLE tasks_p{} PARTITION OF tasks FOR VALUES FROM ('{}') TO ('{}')".format(suffix, start, end))
+
+    op.execute("INSERT INTO tasks ({0}) SELECT {0} FROM tasks_unpartitioned".format(COLUMNS))
+    op.drop_table("tasks_unpartitioned")
+    create_indexes()
+
+
+def downgrade():
+    # Partitions detached by `sql.partitions archive --detach` are left as
+    # they are.
+    set_aside("tasks_partitioned")
+    create_tasks(partitioned=False)
+    op.execute("INSERT INTO tasks ({0}) SELECT {0} FROM tasks_partitioned".format(COLUMNS))
+    op.drop_table("tasks_partitioned")
+    create_indexes()
@@ -0,0 +1,30 @@
+"""users.tombstones_pruned_version and an index for the tombstone cutoff
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2022-11-08
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0009"
+down_revision = "0008"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "users", sa.Column("tombstones_pruned_version", sa.Integer, nullable=False, server_default=sa.text("0"))
+    )
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_task_tombstones_deleted_at", "task_tombstones", ["deleted_at"], postgresql_concurrently=True
+        )
+
+
+def downgrade():
+    op.drop_index("ix_task_tombstones_deleted_at", table_name="task_tombstones")
+    op.drop_column("users", "tombstones_pruned_version")
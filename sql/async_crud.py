@@ -0,0 +1,139 @@
+# Async counterparts of sql.crud.
+#
+# Every function takes either an AsyncSession or a plain Session. With an
+# AsyncSession the crud function runs through AsyncSession.run_sync, so the
+# queries go out on the async driver without touching a thread. With a
+# plain Session it is pushed to a worker thread so the event loop is not
+# blocked either way.
+import functools
+import sys
+
+import anyio
+
+from . import crud
+
+
+def is_async(db):
+    # sqlalchemy.ext.asyncio is slow to import and only loaded once the
+    # async engine is built; no session can be an AsyncSession before that.
+    asyncio_ext = sys.modules.get("sqlalchemy.ext.asyncio")
+    return asyncio_ext is not None and isinstance(db, asyncio_ext.AsyncSession)
+
+async def run(db, fn, *args, **kwargs):
+    if is_async(db):
+        return await db.run_sync(fn, *args, **kwargs)
+    return await anyio.to_thread.run_sync(functools.partial(fn, db, *args, **kwargs))
+
+async def get_user(db, user_id):
+    return await run(db, crud.get_user, user_id)
+
+async def get_users(db):
+    return await run(db, crud.get_users)
+
+async def get_user_rows(db):
+    return await run(db, crud.get_user_rows)
+
+async def get_user_by_username(db, user_name, include_deleted=False):
+    return await run(db, crud.get_user_by_username, user_name, include_deleted)
+
+async def create_user(db, user, hashed_password=None):
+    return await run(db, crud.create_user, user, hashed_password)
+
+async def update_user(db, user_id, user):
+    return await run(db, crud.update_user, user_id, user)
+
+async def delete_user(db, user_id, purge_later=False):
+    return await run(db, crud.delete_user, user_id, purge_later)
+
+async def get_project(db, project_id):
+    return await run(db, crud.get_project, project_id)
+
+async def get_project_by_title(db, name, include_deleted=False):
+    return await run(db, crud.get_project_by_title, name, include_deleted)
+
+async def get_projects(db):
+    return await run(db, crud.get_projects)
+
+async def get_project_catalog(db):
+    return await run(db, crud.get_project_catalog)
+
+async def create_project(db, project):
+    return await run(db, crud.create_project, project)
+
+async def delete_project(db, project_id, purge_later=False):
+    return await run(db, crud.delete_project, project_id, purge_later)
+
+async def purge_deleted(db, batch_size, tombstones_before=None):
+    return await run(db, crud.purge_deleted, batch_size, tombstones_before)
+
+async def update_project(db, project_id, project):
+    return await run(db, crud.update_project, project_id, project)
+
+async def get_task(db, task_id):
+    return await run(db, crud.get_task, task_id)
+
+async def get_tasks_version(db, user_id):
+    return await run(db, crud.get_tasks_version, user_id)
+
+async def get_report_version(db, user_id=None):
+    return await run(db, crud.get_report_version, user_id)
+
+async def get_task_changes(db, user_id, limit, **params):
+    return await run(db, crud.get_task_changes, user_id, limit, **params)
+
+async def get_tasks_page(db, user_id, limit, **filters):
+    return await run(db, crud.get_tasks_page, user_id, limit, **filters)
+
+async def stream_tasks_by_user(db, user_id, date_from=None, date_to=None, batch_size=crud.EXPORT_BATCH_SIZE):
+    if is_async(db):
+        result = await db.stream(crud.task_export_statement(user_id, date_from, date_to))
+        async for rows in result.partitions(batch_size):
+            yield rows
+        return
+
+    batches = crud.stream_tasks_by_user(db, user_id, date_from, date_to, batch_size)
+    while True:
+        rows = await anyio.to_thread.run_sync(next, batches, None)
+        if rows is None:
+            return
+        yield rows
+
+async def get_activity(db, start, end, user_id=None, project_id=None, limit=1000):
+    return await run(db, crud.get_activity, start, end, user_id, project_id, limit)
+
+async def get_overlapping_tasks(db, user_id, date_from=None, date_to=None):
+    return await run(db, crud.get_overlapping_tasks, user_id, date_from, date_to)
+
+async def get_time_report(db, user_id=None, period=None, date_from=None, date_to=None):
+    return await run(db, crud.get_time_report, user_id, period, date_from, date_to)
+
+async def create_task(db, task, user_id, reject_overlaps=False):
+    return await run(db, crud.create_task, task, user_id, reject_overlaps)
+
+async def create_task_batch(db, entries, reject_overlaps=False):
+    return await run(db, crud.create_task_batch, entries, reject_overlaps)
+
+async def bulk_create_tasks(db, tasks, user_id, atomic=False, reject_overlaps=False):
+    return await run(db, crud.bulk_create_tasks, tasks, user_id, atomic, reject_overlaps)
+
+async def delete_task(db, task_id):
+    return await run(db, crud.delete_task, task_id)
+
+async def delete_task_by_user_id(db, user_id):
+    return await run(db, crud.delete_task_by_user_id, user_id)
+
+async def delete_task_by_project_id(db, project_id):
+    return await run(db, crud.delete_task_by_project_id, project_id)
+
+async def update_task(db, task_id, task, reject_overlaps=False):
+    return await run(db, crud.update_task, task_id, task, reject_overlaps)
+
+async def send_notification(db, channel, payload):
+    return await run(db, crud.send_notification, channel, payload)
+
+async def end_transaction(db):
+    # Hands the connection back to the pool, for long-lived handlers that
+    # keep the session around.
+    if is_async(db):
+        return await db.commit()
+    return await anyio.to_thread.run_sync(db.commit)
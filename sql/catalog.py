@@ -0,0 +1,83 @@
+# Process-local copy of the projects table.
+#
+# The table is small and rarely written, so it is loaded whole and kept
+# until a project is created, renamed or deleted. Writes in this process
+# invalidate it directly. Other workers find out through LISTEN/NOTIFY when
+# PROJECT_CATALOG_LISTEN is enabled, and otherwise when the TTL runs out.
+import hashlib
+import os
+import threading
+import time
+from typing import NamedTuple
+
+from sqlalchemy.orm import Session
+
+from . import models
+
+PROJECT_CATALOG_TTL_SECONDS = float(os.getenv("PROJECT_CATALOG_TTL_SECONDS", 300))
+PROJECT_CATALOG_LISTEN = os.getenv("PROJECT_CATALOG_LISTEN", "false").lower() in ("1", "true", "yes", "on")
+CHANNEL = "project_catalog"
+
+
+class CatalogSnapshot(NamedTuple):
+    projects: list
+    by_id: dict
+    etag: str
+    loaded_at: float
+
+
+class ProjectCatalog:
+    def __init__(self, ttl: float = PROJECT_CATALOG_TTL_SECONDS, timer=time.monotonic):
+        self.ttl = ttl
+        self._timer = timer
+        self._snapshot = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _fresh(self):
+        snapshot = self._snapshot
+        if snapshot is None or self._timer() - snapshot.loaded_at >= self.ttl:
+            return None
+        return snapshot
+
+    def snapshot(self, db: Session):
+        snapshot = self._fresh()
+        if snapshot is not None:
+            return snapshot
+
+        # The query runs without the lock held: with an AsyncSession it
+        # yields to the event loop, and a blocked lock would stall it. A
+        # load that raced with an invalidation is returned but not kept.
+        generation = self._generation
+        rows = db.query(models.Project.id, models.Project.name).filter(models.Project.deleted_at.is_(None)).order_by(models.Project.id).all()
+        projects = [{ "id" : row.id, "name" : row.name } for row in rows]
+        digest = hashlib.sha1()
+        for project in projects:
+            digest.update("{}:{}\n".format(project["id"], project["name"]).encode())
+        snapshot = CatalogSnapshot(
+            projects=projects,
+            by_id={ project["id"] : project for project in projects },
+            etag='W/"{}"'.format(digest.hexdigest()[:20]),
+            loaded_at=self._timer()
+        )
+
+        with self._lock:
+            if self.ttl > 0 and generation == self._generation:
+                self._snapshot = snapshot
+        return snapshot
+
+    def name(self, project_id: int):
+        # Cached name only; never queries.
+        snapshot = self._fresh()
+        if snapshot is None:
+            return None
+        project = snapshot.by_id.get(project_id)
+        return None if project is None else project["name"]
+
+    def invalidate(self, payload=None):
+        with self._lock:
+            self._generation += 1
+            self._snapshot = None
+
+
+project_catalog = ProjectCatalog()
@@ -1,22 +1,49 @@
-from sqlalchemy.orm import Session 
-from . import models, schemas 
+import base64
+import bisect
+import os
+from datetime import date, datetime, timezone
+from sqlalchemy import Date, and_, bindparam, cast, delete, func, insert, literal, select, text, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, aliased
+from . import catalog, models, schemas 
+from .catalog import project_catalog
+from .notify import notify
 from passlib.context import CryptContext
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
 
-def get_user(db: Session, user_id: int):
-    return db.query(models.User).filter(models.User.id == user_id).first()
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 
-def get_users(db: Session):
-    return db.query(models.User).all()
+# Users and projects marked deleted are hidden from reads until the purge
+# removes them.
+active_user = models.User.deleted_at.is_(None)
+active_project = models.Project.deleted_at.is_(None)
 
-def get_user_by_username(db: Session, user_name):
-    return db.query(models.User).filter(models.User.user_name == user_name).first()
+def get_user(db: Session, user_id: int):
+    return db.query(models.User).filter(models.User.id == user_id).filter(active_user).first()
 
-def create_user(db: Session, user: schemas.UserCreate):
+def get_users(db: Session):
+    return db.query(models.User).filter(active_user).all()
+
+def get_user_rows(db: Session):
+    rows = db.query(models.User.id, models.User.user_name, models.User.email).filter(active_user).order_by(models.User.id).all()
+    return [row._asdict() for row in rows]
+
+def get_user_by_username(db: Session, user_name, include_deleted: bool = False):
+    # include_deleted for uniqueness checks: the name stays taken until the
+    # purge removes the row.
+    query = db.query(models.User).filter(models.User.user_name == user_name)
+    if not include_deleted:
+        query = query.filter(active_user)
+    return query.first()
+
+def create_user(db: Session, user: schemas.UserCreate, hashed_password: str = None):
+    if hashed_password is None:
+        hashed_password = get_password_hash(user.password)
     db_user = models.User(
         user_name=user.user_name,
-        password = get_password_hash(user.password),
+        password = hashed_password,
         email=user.email
     )
 
@@ -31,8 +58,17 @@ def update_user(db: Session, user_id: int, user: schemas.User):
     db_user = get_user(db, user_id)
     return db_user
 
-def delete_user(db: Session, user_id: int):
-    db.query(models.User).filter(models.User.id == user_id).delete()
+def delete_user(db: Session, user_id: int, purge_later: bool = False):
+    # The user's tasks go with it through ON DELETE CASCADE, in the same
+    # transaction, and so do its tombstones; nobody is left to sync them.
+    # With purge_later the user is only marked and purge_deleted removes the
+    # tasks in batches.
+    users = models.User.__table__
+    if purge_later:
+        db.execute(update(users).where(users.c.id == user_id).values(deleted_at=func.now()))
+    else:
+        db.execute(delete(models.TaskTombstone.__table__).where(models.TaskTombstone.user_id == user_id))
+        db.execute(delete(users).where(users.c.id == user_id))
     db.commit()
     return { "success" : True }
 
@@ -42,23 +78,30 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
-def authenticate_user(db: Session, user_name: str, password: str):
-    user = get_user_by_username(db, user_name)
-    if not user:
-        return False 
-    if not verify_password(password, user.password):
-        return False 
-
-    return user 
+def send_notification(db: Session, channel: str, payload: str):
+    notify(db, channel, payload)
+    db.commit()
 
 def get_project(db: Session, project_id: int):
-    return db.query(models.Project).filter(models.Project.id == project_id).first()
+    return db.query(models.Project).filter(models.Project.id == project_id).filter(active_project).first()
 
-def get_project_by_title(db: Session, name: str):
-    return db.query(models.Project).filter(models.Project.name == name).first()
+def get_project_by_title(db: Session, name: str, include_deleted: bool = False):
+    query = db.query(models.Project).filter(models.Project.name == name)
+    if not include_deleted:
+        query = query.filter(active_project)
+    return query.first()
 
 def get_projects(db: Session):
-    return db.query(models.Project).all()
+    return db.query(models.Project).filter(active_project).all()
+
+def get_project_catalog(db: Session):
+    return project_catalog.snapshot(db)
+
+def commit_project_change(db: Session):
+    if catalog.PROJECT_CATALOG_LISTEN:
+        notify(db, catalog.CHANNEL)
+    db.commit()
+    project_catalog.invalidate()
 
 def create_project(db: Session, project: schemas.ProjectCreate):
     db_project = models.Project(
@@ -66,106 +109,760 @@ def create_project(db: Session, project: schemas.ProjectCreate):
     )
 
     db.add(db_project)
-    db.commit()
+    commit_project_change(db)
     db.refresh(db_project)
     return db_project
 
-def delete_project(db: Session, project_id: int):
-    db.query(models.Project).filter(models.Project.id == project_id).delete()
-    db.commit()
+def delete_project(db: Session, project_id: int, purge_later: bool = False):
+    # One transaction: the tasks' owners get tombstones and a version bump,
+    # then ON DELETE CASCADE removes the tasks with the project. With
+    # purge_later the project is only marked; its tasks disappear from reads
+    # right away and purge_deleted removes them in batches.
+    projects = models.Project.__table__
+    in_project = models.Task.project_id == project_id
+    if purge_later:
+        db.execute(bump_tasks_version(task_owners(in_project)))
+        db.execute(update(projects).where(projects.c.id == project_id).values(deleted_at=func.now()))
+    else:
+        tasks = models.Task.__table__
+        db.execute(insert_tombstones(bumped_versions(task_owners(in_project)), tasks.c.id, tasks.c.user_id, in_project))
+        db.execute(delete(projects).where(projects.c.id == project_id))
+    commit_project_change(db)
     return { "success" : True }
 
+def purge_deleted(db: Session, batch_size: int, tombstones_before: datetime = None):
+    # Removes one batch of tasks belonging to users or projects marked
+    # deleted, leaving tombstones, and returns how many went. Then, with
+    # tombstones_before, batches of tombstones left before it. Once nothing
+    # is left the marked rows themselves are deleted, users with their
+    # tombstones, and 0 is returned. SKIP LOCKED lets several workers purge
+    # side by side.
+    doomed = db.execute(
+        select(models.Task.id)
+            .where(
+                models.Task.user_id.in_(select(models.User.id).where(models.User.deleted_at.isnot(None)))
+                | models.Task.project_id.in_(select(models.Project.id).where(models.Project.deleted_at.isnot(None)))
+            )
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+    ).scalars().all()
+    if doomed:
+        delete_tasks(db, models.Task.id.in_(doomed))
+        return len(doomed)
+    if tombstones_before is not None:
+        pruned = prune_tombstones(db, tombstones_before, batch_size)
+        if pruned:
+            return pruned
+
+    users = models.User.__table__
+    deleted_users = delete(users).where(users.c.deleted_at.isnot(None)).returning(users.c.id).cte("deleted_users")
+    tombstones = models.TaskTombstone.__table__
+    db.execute(delete(tombstones).where(tombstones.c.user_id.in_(select(deleted_users.c.id))).add_cte(deleted_users))
+    projects = db.execute(delete(models.Project.__table__).where(models.Project.deleted_at.isnot(None)))
+    if projects.rowcount:
+        commit_project_change(db)
+    else:
+        db.commit()
+    return 0
+
+def prune_tombstones(db: Session, before: datetime, batch_size: int):
+    # Deletes one batch of tombstones left before `before` and returns how
+    # many went. Each owner's tombstones_pruned_version moves up in the same
+    # transaction, so GET /tasks/changes can tell a client that missed them.
+    tombstones = models.TaskTombstone.__table__
+    expired = (
+        select(tombstones.c.user_id, tombstones.c.task_id)
+            .where(tombstones.c.deleted_at < before)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+    )
+    rows = db.execute(
+        delete(tombstones)
+            .where(tuple_(tombstones.c.user_id, tombstones.c.task_id).in_(expired))
+            .returning(tombstones.c.user_id, tombstones.c.version)
+    ).all()
+    newest = {}
+    for user_id, version in rows:
+        newest[user_id] = max(version, newest.get(user_id, version))
+    if newest:
+        users = models.User.__table__
+        db.execute(
+            update(users)
+                .where(users.c.id == bindparam("user_id"))
+                .values(tombstones_pruned_version=func.greatest(users.c.tombstones_pruned_version, bindparam("pruned"))),
+            [{ "user_id" : user_id, "pruned" : newest[user_id] } for user_id in sorted(newest)]
+        )
+    db.commit()
+    return len(rows)
+
 def update_project(db: Session, project_id: int, project: schemas.Project):
+    # Tasks carry the project name, so they count as changed for their owners
+    tasks = models.Task.__table__
+    bumped = bumped_versions(task_owners(models.Task.project_id == project_id))
+    db.execute(
+        update(tasks)
+            .where(tasks.c.project_id == project_id)
+            .where(tasks.c.user_id == bumped.c.id)
+            .values(version=bumped.c.tasks_version)
+    )
     db.query(models.Project).filter(models.Project.id == project_id).update(project.dict())
-    db.commit()
+    commit_project_change(db)
     db_project = get_project(db, project_id)
     return db_project
 
 def get_task(db: Session, task_id: int):
     return db.query(models.Task).filter(models.Task.id == task_id).first() 
 
-def get_tasks_by_user(db: Session, user_id: int):
-    query = db.query(models.Task, models.Project).filter(models.Task.project_id == models.Project.id).filter(models.Task.user_id == user_id).all()
-    tasks = []
-    for t, p in query:
-        tasks.append({
-            'id' : t.id,
-            'user_id' : t.user_id, 
-            'project_id' : t.project_id,
-            'start_time' : t.start_time,
-            'end_time' : t.end_time,
-            'task_date' : t.task_date,
-            'description' : t.description,
-            'duration' : t.duration,
-            'project_name' : p.name
-        })
-
-    return tasks
-
-def get_tasks_by_project(db: Session, project_id: int):
-    return db.query(models.Task).filter(models.Task.project_id == project_id).all()
-
-def create_task(db: Session, task: schemas.TaskCreate, user_id: int):
-    print("FAVS")
-    db_task = models.Task(
-        user_id=user_id,
-        project_id=task.project_id,
-        start_time=task.start_time,
-        end_time=task.end_time,
-        task_date=task.task_date,
-        duration=task.duration,
-        description=task.description
-    )
-
-    db.add(db_task)
-    db.commit()
-    db.refresh(db_task)
-
-    db_project = db.query(models.Project).filter(models.Project.id == db_task.project_id).first()
+def encode_task_cursor(task_date: date, task_id: int):
+    raw = "{}|{}".format(task_date.isoformat(), task_id)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_task_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw_date, raw_id = base64.urlsafe_b64decode(padded.encode()).decode().split("|")
+        return date.fromisoformat(raw_date), int(raw_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+
+def get_tasks_page(
+    db: Session,
+    user_id: int,
+    limit: int,
+    cursor: str = None,
+    date_from: date = None,
+    date_to: date = None,
+    project_id: int = None
+):
+    # Keyset pagination on (task_date, id), newest first. One extra row is
+    # fetched to find out whether another page exists.
+    query = db.query(
+        models.Task.id,
+        models.Task.user_id,
+        models.Task.project_id,
+        models.Task.start_time,
+        models.Task.end_time,
+        models.Task.task_date,
+        models.Task.description,
+        models.Task.duration,
+        models.Project.name.label("project_name")
+    ).join(models.Project, models.Task.project_id == models.Project.id).filter(models.Task.user_id == user_id).filter(active_project)
+
+    if date_from is not None:
+        query = query.filter(models.Task.task_date >= date_from)
+    if date_to is not None:
+        query = query.filter(models.Task.task_date <= date_to)
+    if project_id is not None:
+        query = query.filter(models.Task.project_id == project_id)
+    if cursor is not None:
+        query = query.filter(tuple_(models.Task.task_date, models.Task.id) < decode_task_cursor(cursor))
+
+    rows = query.order_by(models.Task.task_date.desc(), models.Task.id.desc()).limit(limit + 1).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = None
+    if has_more:
+        next_cursor = encode_task_cursor(rows[-1].task_date, rows[-1].id)
 
     return {
-        "id" : db_task.id,
-        "user_id" : db_task.user_id,
-        "project_id" : db_task.project_id,
-        "start_time" : db_task.start_time,
-        "end_time" : db_task.end_time,
-        "task_date" : db_task.task_date,
-        "duration" : db_task.duration,
-        "description" : db_task.duration,
-        "project_name" : db_project.__dict__["name"]
+        "tasks" : [row._asdict() for row in rows],
+        "next_cursor" : next_cursor,
+        "has_more" : has_more
     }
 
-def delete_task(db: Session, task_id: int):
-    db.query(models.Task).filter(models.Task.id == task_id).delete()
-    db.commit()
-    return { "success" : True }
+def encode_change_cursor(upto: int, version: int, task_id: int):
+    raw = "{}|{}|{}".format(upto, version, task_id)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_change_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        upto, version, task_id = base64.urlsafe_b64decode(padded.encode()).decode().split("|")
+        return int(upto), int(version), int(task_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+
+def get_task_changes(db: Session, user_id: int, limit: int, since: int = None, cursor: str = None):
+    # Tasks written and tombstones left after `since`, in (version, id)
+    # order. Pages stop at the tasks_version read first, which the response
+    # returns as the `since` of the next sync. Omitting `since` returns every
+    # task. ChangesPrunedError means tombstones after `since` were pruned, and
+    # the client has to sync again without it.
+    if cursor is not None:
+        upto, after_version, after_id = decode_change_cursor(cursor)
+    else:
+        upto = get_tasks_version(db, user_id)
+        if upto is None:
+            return None
+        # every id comes after 0, and since means "newer than"
+        after_version, after_id = (-1 if since is None else since + 1), 0
+
+    tasks = db.execute(
+        select(
+            models.Task.version,
+            models.Task.id,
+            models.Task.user_id,
+            models.Task.project_id,
+            models.Task.start_time,
+            models.Task.end_time,
+            models.Task.task_date,
+            models.Task.description,
+            models.Task.duration,
+            models.Project.name.label("project_name")
+        ).outerjoin(models.Project, models.Task.project_id == models.Project.id)
+            .where(models.Task.user_id == user_id)
+            .where(tuple_(models.Task.version, models.Task.id) > (after_version, after_id))
+            .where(models.Task.version <= upto)
+            .order_by(models.Task.version, models.Task.id)
+            .limit(limit + 1)
+    ).all()
+    tombstones = db.execute(
+        select(models.TaskTombstone.version, models.TaskTombstone.task_id.label("id"))
+            .where(models.TaskTombstone.user_id == user_id)
+            .where(tuple_(models.TaskTombstone.version, models.TaskTombstone.task_id) > (after_version, after_id))
+            .where(models.TaskTombstone.version <= upto)
+            .order_by(models.TaskTombstone.version, models.TaskTombstone.task_id)
+            .limit(limit + 1)
+    ).all()
+
+    # Read after the tombstones: pruning moves it in the transaction that
+    # deletes them.
+    if since is not None and since < get_tombstones_pruned_version(db, user_id):
+        raise ChangesPrunedError(since)
+
+    changes = [{ **row._asdict(), "deleted" : False } for row in tasks]
+    changes += [{ **row._asdict(), "deleted" : True } for row in tombstones]
+    changes.sort(key=lambda change: (change["version"], change["id"]))
+
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    next_cursor = None
+    if has_more:
+        next_cursor = encode_change_cursor(upto, changes[-1]["version"], changes[-1]["id"])
 
-def delete_task_by_user_id(db: Session, user_id: int):
-    db.query(models.Task).filter(models.Task.user_id == user_id).delete()
-    db.commit()
+    return {
+        "changes" : changes,
+        "version" : upto,
+        "next_cursor" : next_cursor,
+        "has_more" : has_more
+    }
 
-def delete_task_by_project_id(db: Session, project_id: int):
-    db.query(models.Task).filter(models.Task.project_id == project_id).delete()
-    db.commit() 
+EXPORT_BATCH_SIZE = 1000
+TASK_EXPORT_FIELDS = ("id", "task_date", "start_time", "end_time", "duration", "project_id", "project_name", "description")
+
+def task_export_statement(user_id: int, date_from: date = None, date_to: date = None):
+    statement = select(
+        models.Task.id,
+        models.Task.task_date,
+        models.Task.start_time,
+        models.Task.end_time,
+        models.Task.duration,
+        models.Task.project_id,
+        models.Project.name.label("project_name"),
+        models.Task.description
+    ).join(models.Project, models.Task.project_id == models.Project.id).where(models.Task.user_id == user_id).where(active_project)
+
+    if date_from is not None:
+        statement = statement.where(models.Task.task_date >= date_from)
+    if date_to is not None:
+        statement = statement.where(models.Task.task_date <= date_to)
+
+    return statement.order_by(models.Task.task_date, models.Task.id).execution_options(stream_results=True)
+
+def stream_tasks_by_user(db: Session, user_id: int, date_from: date = None, date_to: date = None, batch_size: int = EXPORT_BATCH_SIZE):
+    # Yields lists of rows read through a server-side cursor, so memory use
+    # does not depend on how many tasks the user has.
+    result = db.execute(task_export_statement(user_id, date_from, date_to))
+    for rows in result.partitions(batch_size):
+        yield rows
+
+REPORT_PERIODS = ("day", "week", "month")
+
+def get_time_report(db: Session, user_id: int = None, period: str = None, date_from: date = None, date_to: date = None):
+    # Total duration per project, optionally split into day/week/month
+    # buckets. user_id=None reports across all users.
+    columns = [models.Project.id.label("project_id"), models.Project.name.label("project_name")]
+    if period is not None:
+        if period not in REPORT_PERIODS:
+            raise ValueError("Unknown period {}".format(period))
+        columns.insert(0, cast(func.date_trunc(period, models.Task.task_date), Date).label("period_start"))
+
+    statement = select(
+        *columns,
+        func.sum(models.Task.duration).label("total_duration"),
+        func.count(models.Task.id).label("task_count")
+    ).join(models.Project, models.Task.project_id == models.Project.id).where(active_project)
+
+    if user_id is not None:
+        statement = statement.where(models.Task.user_id == user_id)
+    else:
+        statement = statement.where(models.Task.user_id.in_(select(models.User.id).where(active_user)))
+    if date_from is not None:
+        statement = statement.where(models.Task.task_date >= date_from)
+    if date_to is not None:
+        statement = statement.where(models.Task.task_date <= date_to)
+
+    statement = statement.group_by(*columns).order_by(*columns)
+
+    return [row._asdict() for row in db.execute(statement)]
+
+def naive_utc(moment: datetime):
+    # Task times carry no zone and are compared as UTC
+    if moment.tzinfo is None:
+        return moment
+    return moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+def get_activity(db: Session, start: datetime, end: datetime, user_id: int = None, project_id: int = None, limit: int = 1000):
+    # Tasks of a user and/or project whose time range meets [start, end),
+    # found through the GiST index on time_range. tsrange() takes
+    # timestamps without a zone, so aware bounds are converted first.
+    start, end = naive_utc(start), naive_utc(end)
+    statement = select(
+        models.Task.id,
+        models.Task.user_id,
+        models.Task.project_id,
+        models.Project.name.label("project_name"),
+        func.lower(models.Task.time_range).label("starts_at"),
+        func.upper(models.Task.time_range).label("ends_at"),
+        models.Task.description
+    ).join(models.Project, models.Task.project_id == models.Project.id).where(active_project).where(
+        models.Task.time_range.op("&&")(func.tsrange(start, end, "[)"))
+    )
+    if user_id is not None:
+        statement = statement.where(models.Task.user_id == user_id)
+    if project_id is not None:
+        statement = statement.where(models.Task.project_id == project_id)
+
+    statement = statement.order_by(func.lower(models.Task.time_range), models.Task.id).limit(limit)
+    return [row._asdict() for row in db.execute(statement)]
+
+def get_overlapping_tasks(db: Session, user_id: int, date_from: date = None, date_to: date = None):
+    # Pairs of the user's tasks whose time ranges overlap, with the shared
+    # stretch of time.
+    task, other = aliased(models.Task), aliased(models.Task)
+    shared = task.time_range * other.time_range
+    statement = select(
+        task.id.label("task_id"),
+        other.id.label("other_task_id"),
+        task.task_date,
+        func.lower(shared).label("overlap_starts_at"),
+        func.upper(shared).label("overlap_ends_at")
+    ).join(other, and_(
+        other.user_id == task.user_id,
+        other.id > task.id,
+        other.time_range.op("&&")(task.time_range)
+    )).where(task.user_id == user_id)
+
+    if date_from is not None:
+        statement = statement.where(task.task_date >= date_from)
+    if date_to is not None:
+        statement = statement.where(task.task_date <= date_to)
+
+    statement = statement.order_by(task.task_date, task.id, other.id)
+    return [row._asdict() for row in db.execute(statement)]
+
+def task_columns(table):
+    return (
+        table.c.id,
+        table.c.user_id,
+        table.c.project_id,
+        table.c.start_time,
+        table.c.end_time,
+        table.c.task_date,
+        table.c.duration,
+        table.c.description
+    )
 
-def update_task(db: Session, task_id: int, task: schemas.Task):
-    db.query(models.Task).filter(models.Task.id == task_id).update(task.dict())
-    db.commit()
-    db_task = get_task(db, task_id)
+def get_tasks_version(db: Session, user_id: int):
+    return db.query(models.User.tasks_version).filter(models.User.id == user_id).scalar()
+
+def get_report_version(db: Session, user_id: int = None):
+    # Changes whenever a report of the user's tasks, or with user_id=None of
+    # every active user's, could change: tasks_version covers the task
+    # writes, and the count and newest id of the active users cover users
+    # leaving and joining. Ids only grow, so equal counts and newest ids
+    # mean the same users, whose versions only grow too.
+    if user_id is not None:
+        return get_tasks_version(db, user_id)
+    users = models.User.__table__
+    return tuple(db.execute(
+        select(func.count(), func.coalesce(func.sum(users.c.tasks_version), 0), func.max(users.c.id))
+            .where(users.c.deleted_at.is_(None))
+    ).one())
+
+def get_tombstones_pruned_version(db: Session, user_id: int):
+    return db.query(models.User.tombstones_pruned_version).filter(models.User.id == user_id).scalar()
+
+def bump_tasks_version(user_ids):
+    # user_ids is a list of ids or a select of them
+    users = models.User.__table__
+    return update(users).where(users.c.id.in_(user_ids)).values(tasks_version=users.c.tasks_version + 1)
+
+def bumped_versions(user_ids):
+    # CTE bumping the users' tasks_version and returning (id, tasks_version).
+    # The UPDATE holds the users' row locks until commit, so the writes of a
+    # single user are stamped in the order they commit.
+    users = models.User.__table__
+    return bump_tasks_version(user_ids).returning(users.c.id, users.c.tasks_version).cte("bumped")
+
+def new_version(bumped, user_id):
+    return select(bumped.c.tasks_version).where(bumped.c.id == user_id).scalar_subquery()
+
+def returning_task(statement, table, project_id: int, *extra_columns, ctes=()):
+    # RETURNING the task row together with its project name, so a mutation
+    # is a single statement: the DML runs in a CTE that is joined to
+    # projects. The join is skipped when the project catalog already knows
+    # the project.
+    mutated = statement.returning(*task_columns(table), *extra_columns).cte("mutated")
+    project_name = project_catalog.name(project_id)
+    if project_name is not None:
+        statement = select(mutated)
+    else:
+        # Core columns: the ORM compile path of SQLAlchemy 1.4 drops add_cte()
+        projects = models.Project.__table__
+        statement = select(mutated, projects.c.name.label("project_name")).outerjoin(
+            projects, projects.c.id == mutated.c.project_id
+        )
+    for cte in ctes:
+        statement = statement.add_cte(cte(mutated))
+    return statement, project_name
+
+def insert_tombstones(bumped, task_id, user_id, *criteria):
+    # A user's tombstone for a task is replaced if the task comes back and
+    # leaves again.
+    tombstones = models.TaskTombstone.__table__
+    statement = pg_insert(tombstones).from_select(
+        ["task_id", "user_id", "version"],
+        select(task_id, user_id, bumped.c.tasks_version).join(bumped, bumped.c.id == user_id).where(*criteria)
+    )
+    return statement.on_conflict_do_update(
+        index_elements=[tombstones.c.user_id, tombstones.c.task_id],
+        set_={ "version" : statement.excluded.version, "deleted_at" : func.now() }
+    )
 
-    db_project = get_project(db, db_task.__dict__["project_id"])
+def task_row_to_dict(row, project_name: str = None):
+    task = row._asdict()
+    if project_name is not None:
+        task["project_name"] = project_name
+    return task
+
+class ProjectNotFoundError(Exception):
+    def __init__(self, project_id: int):
+        super().__init__("Project does not exist")
+        self.project_id = project_id
+
+class ChangesPrunedError(Exception):
+    def __init__(self, since: int):
+        super().__init__("Changes since version {} are no longer kept".format(since))
+        self.since = since
+
+class TaskOverlapError(Exception):
+    def __init__(self, task_id: int):
+        super().__init__("Task overlaps task {}".format(task_id))
+        self.task_id = task_id
+
+FIND_OVERLAP = text(
+    "SELECT id FROM tasks WHERE user_id = :user_id AND id IS DISTINCT FROM :task_id AND time_range && "
+    + models.TIME_RANGE_SQL.format(
+        d="CAST(:task_date AS DATE)",
+        s="CAST(CAST(:start_time AS TEXT) AS TIME)",
+        e="CAST(CAST(:end_time AS TEXT) AS TIME)"
+    )
+    + " ORDER BY id LIMIT 1"
+)
+
+def check_overlap(db: Session, user_id: int, task, task_id: int = None):
+    # Locks the user's row first, so two overlapping writes for the same
+    # user cannot both pass the check. The lock is held until commit.
+    db.execute(select(models.User.id).where(models.User.id == user_id).with_for_update())
+    overlapping = db.execute(FIND_OVERLAP, {
+        "user_id" : user_id,
+        "task_id" : task_id,
+        "task_date" : task.task_date,
+        "start_time" : str(task.start_time),
+        "end_time" : str(task.end_time)
+    }).scalar()
+    if overlapping is not None:
+        # Nothing was written; the lock goes when the session is closed
+        raise TaskOverlapError(overlapping)
+
+def overlapping_new_tasks(db: Session, task_ids: list):
+    # {new task id: id of a task it overlaps}, counting existing tasks and
+    # the new ones accepted before it, in id order; a new task that only
+    # overlaps rejected ones is accepted. Existing tasks are checked in the
+    # database, new ones against each other here.
+    new, other = aliased(models.Task), aliased(models.Task)
+    existing = select(func.min(other.id)).where(
+        other.user_id == new.user_id,
+        other.id.notin_(task_ids),
+        other.time_range.op("&&")(new.time_range)
+    ).scalar_subquery()
+    rows = db.execute(
+        select(new.id, new.user_id, func.lower(new.time_range), func.upper(new.time_range), existing)
+            .where(new.id.in_(task_ids))
+            .order_by(new.id)
+    )
 
-    return {
-        "id" : task.id,
-        "user_id" : task.user_id,
+    overlapping = {}
+    # user id: sorted (start, end, task id) of the accepted tasks, which
+    # never overlap each other
+    accepted = {}
+    for task_id, user_id, start, end, existing_id in rows:
+        if existing_id is not None:
+            overlapping[task_id] = existing_id
+            continue
+        if start is None:
+            # no time range, or an empty one: overlaps nothing
+            continue
+        taken = accepted.setdefault(user_id, [])
+        position = bisect.bisect_left(taken, (start,))
+        hits = []
+        if position > 0 and taken[position - 1][1] > start:
+            hits.append(taken[position - 1][2])
+        if position < len(taken) and taken[position][0] < end:
+            hits.append(taken[position][2])
+        if hits:
+            overlapping[task_id] = min(hits)
+        else:
+            taken.insert(position, (start, end, task_id))
+    return overlapping
+
+def project_is_active(project_id: int):
+    return select(models.Project.id).where(models.Project.id == project_id).where(active_project).exists()
+
+def create_task(db: Session, task: schemas.TaskCreate, user_id: int, reject_overlaps: bool = False):
+    # The version bump and the insert only happen when the project is
+    # active, so a missing or deleted project writes nothing.
+    if reject_overlaps:
+        check_overlap(db, user_id, task)
+    table = models.Task.__table__
+    bumped = bumped_versions(select(literal(user_id)).where(project_is_active(task.project_id)))
+    values = {
+        "user_id" : user_id,
         "project_id" : task.project_id,
         "start_time" : task.start_time,
         "end_time" : task.end_time,
         "task_date" : task.task_date,
         "duration" : task.duration,
-        "description" : task.description,
-        "project_name" : db_project.__dict__["name"]
-    } 
+        "description" : task.description
+    }
+    statement, project_name = returning_task(
+        insert(table).from_select(
+            ["version", *values],
+            select(bumped.c.tasks_version, *(literal(value, table.c[name].type) for name, value in values.items()))
+        ),
+        table,
+        task.project_id
+    )
+    row = db.execute(statement).first()
+    if row is None:
+        raise ProjectNotFoundError(task.project_id)
+    db.commit()
+    return task_row_to_dict(row, project_name)
 
+BULK_INSERT_CHUNK_SIZE = 1000
 
+def active_project_names(db: Session, project_ids: set):
+    if not project_ids:
+        return {}
+    return dict(
+        db.query(models.Project.id, models.Project.name).filter(models.Project.id.in_(project_ids)).filter(active_project).all()
+    )
 
+def bulk_create_tasks(db: Session, tasks: list, user_id: int, atomic: bool = False, reject_overlaps: bool = False):
+    # tasks is a list of (index, schemas.TaskCreate). Project ids are checked
+    # with one query and the valid rows go out as multi-row
+    # INSERT ... RETURNING statements inside a single transaction.
+    project_names = active_project_names(db, { task.project_id for _, task in tasks })
+
+    errors = []
+    values = []
+    indexes = []
+    for index, task in tasks:
+        if task.project_id not in project_names:
+            errors.append({ "index" : index, "detail" : "Project does not exist" })
+            continue
+        indexes.append(index)
+        values.append({
+            "user_id" : user_id,
+            "project_id" : task.project_id,
+            "start_time" : task.start_time,
+            "end_time" : task.end_time,
+            "task_date" : task.task_date,
+            "duration" : task.duration,
+            "description" : task.description
+        })
+    if atomic and errors:
+        return { "created" : [], "errors" : errors }
+
+    table = models.Task.__table__
+    created = []
+    if values:
+        version = db.execute(bump_tasks_version([user_id]).returning(models.User.__table__.c.tasks_version)).scalar()
+        for value in values:
+            value["version"] = version
+    for start in range(0, len(values), BULK_INSERT_CHUNK_SIZE):
+        statement = insert(table).values(values[start:start + BULK_INSERT_CHUNK_SIZE]).returning(
+            table.c.id,
+            table.c.user_id,
+            table.c.project_id,
+            table.c.start_time,
+            table.c.end_time,
+            table.c.task_date,
+            table.c.duration,
+            table.c.description
+        )
+        for row in db.execute(statement):
+            task = row._asdict()
+            task["project_name"] = project_names[row.project_id]
+            created.append(task)
+
+    if reject_overlaps and created:
+        # The version bump above already holds the user's row lock
+        overlapping = overlapping_new_tasks(db, [task["id"] for task in created])
+        if overlapping:
+            overlap_errors = [
+                { "index" : index, "detail" : "Task overlaps task {}".format(overlapping[task["id"]]) }
+                for index, task in zip(indexes, created) if task["id"] in overlapping
+            ]
+            if atomic:
+                db.rollback()
+                return { "created" : [], "errors" : errors + overlap_errors }
+            db.execute(delete(table).where(table.c.id.in_(list(overlapping))))
+            created = [task for task in created if task["id"] not in overlapping]
+            errors += overlap_errors
+    db.commit()
+
+    return { "created" : created, "errors" : errors }
+
+def create_task_batch(db: Session, entries: list, reject_overlaps: bool = False):
+    # entries is a list of (user_id, schemas.TaskCreate), from any number of
+    # users, written in one transaction. Returns one result per entry: the
+    # created task, or the exception for that entry alone.
+    project_names = active_project_names(db, { task.project_id for _, task in entries })
+
+    results = [None] * len(entries)
+    positions = []
+    values = []
+    for position, (user_id, task) in enumerate(entries):
+        if task.project_id not in project_names:
+            results[position] = ProjectNotFoundError(task.project_id)
+            continue
+        positions.append(position)
+        values.append({
+            "user_id" : user_id,
+            "project_id" : task.project_id,
+            "start_time" : task.start_time,
+            "end_time" : task.end_time,
+            "task_date" : task.task_date,
+            "duration" : task.duration,
+            "description" : task.description
+        })
+    if not values:
+        return results
+
+    # Row locks are taken in id order so that two batches sharing users
+    # cannot deadlock; every user's rows in the batch share one new version.
+    users = models.User.__table__
+    user_ids = sorted({ value["user_id"] for value in values })
+    db.execute(select(users.c.id).where(users.c.id.in_(user_ids)).order_by(users.c.id).with_for_update())
+    versions = dict(db.execute(bump_tasks_version(user_ids).returning(users.c.id, users.c.tasks_version)).all())
+    for value in values:
+        value["version"] = versions[value["user_id"]]
+
+    # Each chunk goes in under a savepoint, and when it fails, each of its
+    # rows under one of its own: a project deleted since the check above
+    # only fails the entries that use it.
+    table = models.Task.__table__
+    created = {}
+    for start in range(0, len(values), BULK_INSERT_CHUNK_SIZE):
+        chunk = range(start, min(start + BULK_INSERT_CHUNK_SIZE, len(values)))
+        try:
+            with db.begin_nested():
+                rows = db.execute(insert(table).values([values[i] for i in chunk]).returning(*task_columns(table))).all()
+        except IntegrityError:
+            rows = []
+            for i in chunk:
+                try:
+                    with db.begin_nested():
+                        rows.append(db.execute(insert(table).values(values[i]).returning(*task_columns(table))).first())
+                except IntegrityError as e:
+                    rows.append(None)
+                    project_id = values[i]["project_id"]
+                    results[positions[i]] = ProjectNotFoundError(project_id) if "tasks_project_id_fkey" in str(e.orig) else e
+        for i, row in zip(chunk, rows):
+            if row is not None:
+                created[positions[i]] = task_row_to_dict(row, project_names[row.project_id])
+
+    overlapping = overlapping_new_tasks(db, [task["id"] for task in created.values()]) if reject_overlaps else {}
+    if overlapping:
+        db.execute(delete(table).where(table.c.id.in_(list(overlapping))))
+    for position, task in created.items():
+        if task["id"] in overlapping:
+            results[position] = TaskOverlapError(overlapping[task["id"]])
+        else:
+            results[position] = task
+    db.commit()
+    return results
+
+def task_owners(*criteria):
+    return select(models.Task.user_id).where(*criteria)
+
+def delete_tasks(db: Session, *criteria):
+    # Deletes the matching tasks and leaves a tombstone for each one, stamped
+    # with its owner's new tasks_version, in a single statement.
+    table = models.Task.__table__
+    bumped = bumped_versions(task_owners(*criteria))
+    deleted = delete(table).where(*criteria).returning(table.c.id, table.c.user_id).cte("deleted")
+    db.execute(insert_tombstones(bumped, deleted.c.id, deleted.c.user_id))
+    db.commit()
+
+def delete_task(db: Session, task_id: int):
+    delete_tasks(db, models.Task.id == task_id)
+    return { "success" : True }
+
+def delete_task_by_user_id(db: Session, user_id: int):
+    delete_tasks(db, models.Task.user_id == user_id)
+
+def delete_task_by_project_id(db: Session, project_id: int):
+    delete_tasks(db, models.Task.project_id == project_id)
+
+def update_task(db: Session, task_id: int, task: schemas.Task, reject_overlaps: bool = False):
+    # Joining the table to itself exposes the row as it was before the
+    # update: a task that changes hands leaves a tombstone with its previous
+    # owner, in the same statement.
+    # Versions are only bumped under the conditions of the UPDATE itself, so
+    # a missing task or project changes nothing.
+    if reject_overlaps:
+        check_overlap(db, task.user_id, task, task_id)
+    table = models.Task.__table__
+    previous = table.alias("previous")
+    active = project_is_active(task.project_id)
+    owners = task_owners(models.Task.id == task_id)
+    bumped = bumped_versions(
+        select(literal(task.user_id)).where(owners.exists()).union(owners).subquery().select().where(active)
+    )
+    moved = lambda mutated: insert_tombstones(
+        bumped, mutated.c.id, mutated.c.previous_user_id, mutated.c.previous_user_id != mutated.c.user_id
+    ).cte("moved")
+    statement, project_name = returning_task(
+        update(table)
+            .where(table.c.id == task_id)
+            .where(previous.c.id == table.c.id)
+            .where(active)
+            .values({ **task.dict(exclude={ "id" }), "version" : new_version(bumped, task.user_id) }),
+        table,
+        task.project_id,
+        previous.c.user_id.label("previous_user_id"),
+        ctes=(moved,)
+    )
+    row = db.execute(statement).first()
+    if row is None:
+        if not db.query(active).scalar():
+            raise ProjectNotFoundError(task.project_id)
+        return None
+    db.commit()
+    db_task = task_row_to_dict(row, project_name)
+    del db_task["previous_user_id"]
+    return db_task
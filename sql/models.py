@@ -1,38 +1,131 @@
 # coding: utf-8
-from sqlalchemy import Column, Date, ForeignKey, Integer, String, Time, text
+from sqlalchemy import DDL, Column, Computed, Date, DateTime, Float, ForeignKey, Index, Integer, String, Time, UniqueConstraint, cast, text, type_coerce
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import TSRANGE
 from sqlalchemy.orm import relationship
+from sqlalchemy.types import TypeDecorator
 from .database import Base
 
 metadata = Base.metadata
 
 
+class _TimeLiteral(TypeDecorator):
+    impl = String
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None or isinstance(value, str):
+            return value
+        return value.isoformat()
+
+
+class TimeText(TypeDecorator):
+    # Times are sent as text and parsed by PostgreSQL, so inputs such as
+    # "1500" behave the same on psycopg2 and asyncpg.
+    impl = Time
+    cache_ok = True
+
+    def bind_expression(self, bindvalue):
+        return cast(type_coerce(bindvalue, _TimeLiteral()), Time)
+
+
+# When a task happened, as [start, end). An end time before the start time
+# runs past midnight; equal times give an empty range, which overlaps
+# nothing. Rendered with placeholders so crud can apply it to parameters.
+TIME_RANGE_SQL = (
+    "CASE WHEN {d} IS NULL OR {s} IS NULL OR {e} IS NULL THEN NULL "
+    "ELSE tsrange({d} + {s}, {d} + {e} + CASE WHEN {e} < {s} THEN interval '1 day' ELSE interval '0' END, '[)') END"
+)
+
+
 class Project(Base):
     __tablename__ = 'projects'
+    __table_args__ = (
+        UniqueConstraint('name', name='uq_projects_name'),
+    )
 
     id = Column(Integer, primary_key=True, server_default=text("nextval('projects_id_seq'::regclass)"))
     name = Column(String(255))
+    # Set when the project is deleted with DELETE_MODE=purge
+    deleted_at = Column(DateTime(timezone=True))
 
 
 class User(Base):
     __tablename__ = 'users'
+    __table_args__ = (
+        UniqueConstraint('user_name', name='uq_users_user_name'),
+    )
 
     id = Column(Integer, primary_key=True, server_default=text("nextval('users_id_seq'::regclass)"))
     user_name = Column(String(255))
     password = Column(String(255))
     email = Column(String(255))
+    # Bumped by every write that changes what GET /tasks returns for the
+    # user; the list's ETag is derived from it.
+    tasks_version = Column(Integer, nullable=False, server_default=text("0"))
+    # Newest tombstone version removed by the retention cutoff; changes
+    # since an older version can no longer be listed.
+    tombstones_pruned_version = Column(Integer, nullable=False, server_default=text("0"))
+    # Set when the user is deleted with DELETE_MODE=purge
+    deleted_at = Column(DateTime(timezone=True))
 
 
 class Task(Base):
+    # Range-partitioned on task_date (see sql.partitions), so the primary
+    # key has to include it. The mapper still identifies tasks by id alone.
     __tablename__ = 'tasks'
+    __table_args__ = (
+        Index('ix_tasks_user_id_task_date_id', 'user_id', 'task_date', 'id'),
+        Index('ix_tasks_project_id', 'project_id'),
+        Index('ix_tasks_user_id_version_id', 'user_id', 'version', 'id'),
+        Index('ix_tasks_time_range', 'time_range', postgresql_using='gist'),
+        { 'postgresql_partition_by' : 'RANGE (task_date)' },
+    )
 
     id = Column(Integer, primary_key=True, server_default=text("nextval('tasks_id_seq'::regclass)"))
-    user_id = Column(ForeignKey('users.id'))
-    project_id = Column(ForeignKey('projects.id'))
-    start_time = Column(Time)
-    end_time = Column(Time)
-    task_date = Column(Date)
+    user_id = Column(ForeignKey('users.id', ondelete='CASCADE'))
+    project_id = Column(ForeignKey('projects.id', ondelete='CASCADE'))
+    start_time = Column(TimeText)
+    end_time = Column(TimeText)
+    task_date = Column(Date, primary_key=True)
     duration = Column(Integer)
     description = Column(String(255))
+    # The owner's tasks_version as of the last write to the task
+    version = Column(Integer, nullable=False, server_default=text("0"))
+    time_range = Column(TSRANGE, Computed(TIME_RANGE_SQL.format(d="task_date", s="start_time", e="end_time"), persisted=True))
 
     project = relationship('Project')
-    user = relationship('User')
\ No newline at end of file
+    user = relationship('User')
+
+    __mapper_args__ = { 'primary_key' : [id] }
+
+
+# Rows outside every dated partition land here until a partition for their
+# period is created.
+event.listen(Task.__table__, 'after_create', DDL('CREATE TABLE tasks_default PARTITION OF tasks DEFAULT'))
+
+
+class TaskTombstone(Base):
+    # Left behind when a task is deleted or moves to another user, so
+    # GET /tasks/changes can report it. No foreign key: tombstones outlive
+    # their users.
+    __tablename__ = 'task_tombstones'
+    __table_args__ = (
+        Index('ix_task_tombstones_user_id_version_task_id', 'user_id', 'version', 'task_id'),
+        Index('ix_task_tombstones_deleted_at', 'deleted_at'),
+    )
+
+    user_id = Column(Integer, primary_key=True)
+    task_id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+    deleted_at = Column(DateTime(timezone=True), nullable=False, server_default=text("now()"))
+
+
+class RateLimitBucket(Base):
+    # Shared token buckets for RATE_LIMIT_BACKEND=postgres. The migration
+    # creates the table UNLOGGED: losing it in a crash only resets limits.
+    __tablename__ = 'rate_limit_buckets'
+
+    key = Column(String(255), primary_key=True)
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(DateTime(timezone=True), nullable=False)
@@ -0,0 +1,101 @@
+# Cross-process notifications over PostgreSQL LISTEN/NOTIFY.
+#
+# A PgListener owns one dedicated connection (outside the pool) and a daemon
+# thread that waits on it. Callbacks run on that thread, so they must be
+# quick and thread-safe; hand work over to an event loop with
+# call_soon_threadsafe if needed. After a lost connection every callback
+# is called with payload None, since notifications may have been missed.
+import logging
+import select
+import threading
+
+from sqlalchemy import text
+
+from .database import get_engine
+
+logger = logging.getLogger(__name__)
+
+RECONNECT_DELAY_SECONDS = 1.0
+POLL_INTERVAL_SECONDS = 1.0
+
+
+def notify(db, channel: str, payload: str = ""):
+    # Delivered when db's transaction commits, and dropped on rollback.
+    db.execute(text("SELECT pg_notify(:channel, :payload)"), { "channel" : channel, "payload" : payload })
+
+
+class PgListener:
+    def __init__(self, bind=None):
+        # None means the application engine, looked up when connecting.
+        self._bind = bind
+        self._callbacks = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def subscribe(self, channel: str, callback):
+        self._callbacks.setdefault(channel, []).append(callback)
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="pg-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=POLL_INTERVAL_SECONDS * 2)
+            self._thread = None
+
+    def _dispatch(self, channel, payload):
+        for callback in self._callbacks.get(channel, []):
+            try:
+                callback(payload)
+            except Exception:
+                logger.exception("LISTEN callback for %s failed", channel)
+
+    def _connect(self):
+        connection = (self._bind or get_engine()).raw_connection()
+        connection.detach()
+        dbapi_connection = connection.connection
+        dbapi_connection.autocommit = True
+        cursor = dbapi_connection.cursor()
+        for channel in self._callbacks:
+            cursor.execute('LISTEN "{}"'.format(channel.replace('"', '""')))
+        return connection, dbapi_connection
+
+    def _run(self):
+        reconnected = False
+        while not self._stop.is_set():
+            try:
+                connection, dbapi_connection = self._connect()
+            except Exception:
+                logger.warning("LISTEN connection failed, retrying", exc_info=True)
+                self._stop.wait(RECONNECT_DELAY_SECONDS)
+                continue
+
+            if reconnected:
+                for channel in self._callbacks:
+                    self._dispatch(channel, None)
+            reconnected = True
+
+            try:
+                while not self._stop.is_set():
+                    if select.select([dbapi_connection], [], [], POLL_INTERVAL_SECONDS) == ([], [], []):
+                        continue
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        notification = dbapi_connection.notifies.pop(0)
+                        self._dispatch(notification.channel, notification.payload)
+            except Exception:
+                logger.warning("LISTEN connection lost, reconnecting", exc_info=True)
+                self._stop.wait(RECONNECT_DELAY_SECONDS)
+            finally:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+
+
+listener = PgListener()
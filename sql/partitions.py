@@ -0,0 +1,250 @@
+"""Partitions of the tasks table, one per month (or year) of task_date.
+
+    python -m sql.partitions list
+    python -m sql.partitions create [--ahead 3]
+    python -m sql.partitions archive --before 2021-01-01 --export /backups --drop
+    python -m sql.partitions archive --before 2021-01-01 --detach
+
+The application creates the partitions for the current period and the next
+TASK_PARTITIONS_AHEAD periods on its own. Rows for other dates go to
+tasks_default, and are moved out into partitions of their own at the next
+check, unless their period was archived with --detach.
+
+archive handles every partition that ends on or before --before. --export
+writes each one to DIR/<partition>.csv.gz (the columns COPY can load back
+into tasks). --drop then drops it, and --detach leaves it as a standalone
+table. Archived tasks leave no tombstones; instead their owners'
+tasks_version moves on and GET /tasks/changes tells clients that synced
+before it to sync again from scratch.
+
+Uses DATABASE_URL like the application.
+"""
+import argparse
+import gzip
+import logging
+import os
+import re
+import sys
+from datetime import date
+from typing import NamedTuple
+
+import anyio
+from sqlalchemy import text
+
+from . import models
+
+logger = logging.getLogger(__name__)
+
+TASK_PARTITION_INTERVAL = os.getenv("TASK_PARTITION_INTERVAL", "month")
+TASK_PARTITIONS_AHEAD = int(os.getenv("TASK_PARTITIONS_AHEAD", 3))
+TASK_PARTITION_CHECK_SECONDS = float(os.getenv("TASK_PARTITION_CHECK_SECONDS", 3600))
+
+DEFAULT_PARTITION = "tasks_default"
+# Partitions, attached or archived; migrations leave them alone
+PARTITION_NAME = re.compile(r"^tasks_(default|p\d{4}(_\d{2})?)$")
+BOUNDS = re.compile(r"FROM \('([\d-]+)'\) TO \('([\d-]+)'\)")
+# pg_try_advisory_xact_lock key, so only one worker creates partitions
+LOCK_KEY = 7310422
+
+# Generated columns cannot be copied in; PostgreSQL computes them again
+COLUMNS = ", ".join(column.name for column in models.Task.__table__.columns if column.computed is None)
+
+
+class Partition(NamedTuple):
+    name: str
+    start: date = None
+    end: date = None
+
+
+def period_start(day: date, interval: str = TASK_PARTITION_INTERVAL):
+    return date(day.year, 1, 1) if interval == "year" else date(day.year, day.month, 1)
+
+def next_period(start: date, interval: str = TASK_PARTITION_INTERVAL):
+    if interval == "year" or start.month == 12:
+        return date(start.year + 1, 1, 1)
+    return date(start.year, start.month + 1, 1)
+
+def partition_name(start: date, interval: str = TASK_PARTITION_INTERVAL):
+    return "tasks_p{:%Y}".format(start) if interval == "year" else "tasks_p{:%Y_%m}".format(start)
+
+def is_partitioned(connection):
+    return connection.execute(text("SELECT relkind FROM pg_class WHERE oid = 'tasks'::regclass")).scalar() == "p"
+
+def list_partitions(connection):
+    # Dated partitions in order, then the default one
+    rows = connection.execute(text("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'tasks'::regclass
+    """))
+    partitions = []
+    for name, bound in rows:
+        match = BOUNDS.search(bound)
+        if match:
+            partitions.append(Partition(name, date.fromisoformat(match[1]), date.fromisoformat(match[2])))
+        else:
+            partitions.append(Partition(name))
+    return sorted(partitions, key=lambda partition: (partition.start is None, partition.start))
+
+def create_partition(connection, start: date, interval: str = TASK_PARTITION_INTERVAL):
+    partition = Partition(partition_name(start, interval), start, next_period(start, interval))
+    params = { "start" : partition.start, "end" : partition.end }
+    in_range = "task_date >= :start AND task_date < :end"
+    create = text("CREATE TABLE {} PARTITION OF tasks FOR VALUES FROM ('{}') TO ('{}')".format(
+        partition.name, partition.start, partition.end
+    ))
+
+    has_default = connection.execute(text("SELECT to_regclass(:name)"), { "name" : DEFAULT_PARTITION }).scalar()
+    if not has_default or not connection.execute(
+        text("SELECT EXISTS (SELECT 1 FROM {} WHERE {})".format(DEFAULT_PARTITION, in_range)), params
+    ).scalar():
+        connection.execute(create)
+        return partition
+
+    # A partition cannot be created over rows sitting in the default one:
+    # the default is detached while they are moved across.
+    connection.execute(text("ALTER TABLE tasks DETACH PARTITION {}".format(DEFAULT_PARTITION)))
+    connection.execute(create)
+    connection.execute(text("INSERT INTO tasks ({0}) SELECT {0} FROM {1} WHERE {2}".format(COLUMNS, DEFAULT_PARTITION, in_range)), params)
+    connection.execute(text("DELETE FROM {} WHERE {}".format(DEFAULT_PARTITION, in_range)), params)
+    connection.execute(text("ALTER TABLE tasks ATTACH PARTITION {} DEFAULT".format(DEFAULT_PARTITION)))
+    return partition
+
+def default_periods(connection, interval: str = TASK_PARTITION_INTERVAL):
+    # Periods with rows sitting in the default partition
+    if not connection.execute(text("SELECT to_regclass(:name)"), { "name" : DEFAULT_PARTITION }).scalar():
+        return []
+    return connection.execute(text(
+        "SELECT DISTINCT date_trunc(:interval, task_date)::date FROM {} WHERE task_date IS NOT NULL".format(DEFAULT_PARTITION)
+    ), { "interval" : "year" if interval == "year" else "month" }).scalars().all()
+
+def ensure_partitions(connection, today: date = None, ahead: int = TASK_PARTITIONS_AHEAD, interval: str = TASK_PARTITION_INTERVAL):
+    # Creates the partitions missing from the current period through `ahead`
+    # periods later, and for the periods of rows in the default partition,
+    # and returns them. Periods overlapping an existing partition, say after
+    # a change of interval, are skipped, and so are periods archived with
+    # --detach, whose table still has the partition's name. Another worker
+    # already at it makes this a no-op.
+    if not connection.execute(text("SELECT pg_try_advisory_xact_lock(:key)"), { "key" : LOCK_KEY }).scalar():
+        return []
+    existing = [partition for partition in list_partitions(connection) if partition.start is not None]
+    starts = set(default_periods(connection, interval))
+    start = period_start(today or date.today(), interval)
+    for _ in range(ahead + 1):
+        starts.add(start)
+        start = next_period(start, interval)
+
+    created = []
+    for start in sorted(starts):
+        end = next_period(start, interval)
+        if any(partition.start < end and start < partition.end for partition in existing):
+            continue
+        if connection.execute(text("SELECT to_regclass(:name)"), { "name" : partition_name(start, interval) }).scalar():
+            continue
+        created.append(create_partition(connection, start, interval))
+    return created
+
+def maintain(engine):
+    with engine.begin() as connection:
+        if not is_partitioned(connection):
+            return []
+        return ensure_partitions(connection)
+
+async def watch(get_engine, interval: float = TASK_PARTITION_CHECK_SECONDS):
+    while True:
+        try:
+            for partition in await anyio.to_thread.run_sync(maintain, get_engine()):
+                logger.info("Created partition %s for %s to %s", partition.name, partition.start, partition.end)
+        except Exception:
+            logger.exception("Creating task partitions failed")
+        await anyio.sleep(interval)
+
+def partitions_before(connection, before: date):
+    return [partition for partition in list_partitions(connection) if partition.end is not None and partition.end <= before]
+
+def export_partition(connection, partition: Partition, directory: str):
+    # Returns the file written and the number of rows in it
+    path = os.path.join(directory, partition.name + ".csv.gz")
+    cursor = connection.connection.cursor()
+    try:
+        with gzip.open(path, "wb") as f:
+            cursor.copy_expert(
+                "COPY (SELECT {} FROM {} ORDER BY id) TO STDOUT WITH (FORMAT csv, HEADER)".format(COLUMNS, partition.name), f
+            )
+        return path, cursor.rowcount
+    finally:
+        cursor.close()
+
+def retire_owners(connection, partition: Partition):
+    # The owners' task lists change, so their tasks_version moves on. The
+    # tasks leave no tombstones, so changes since an older version can no
+    # longer be listed either. Runs in the transaction that removes them.
+    connection.execute(text("""
+        UPDATE users SET tasks_version = tasks_version + 1, tombstones_pruned_version = tasks_version + 1
+        WHERE id IN (SELECT DISTINCT user_id FROM {})
+    """.format(partition.name)))
+
+def detach_partition(connection, partition: Partition):
+    retire_owners(connection, partition)
+    connection.execute(text("ALTER TABLE tasks DETACH PARTITION {}".format(partition.name)))
+
+def drop_partition(connection, partition: Partition):
+    retire_owners(connection, partition)
+    connection.execute(text("DROP TABLE {}".format(partition.name)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list")
+    create = commands.add_parser("create")
+    create.add_argument("--ahead", type=int, default=TASK_PARTITIONS_AHEAD)
+    archive = commands.add_parser("archive")
+    archive.add_argument("--before", type=date.fromisoformat, required=True)
+    archive.add_argument("--export", metavar="DIR")
+    action = archive.add_mutually_exclusive_group()
+    action.add_argument("--detach", action="store_true")
+    action.add_argument("--drop", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.command == "archive" and not (args.export or args.detach or args.drop):
+        parser.error("archive needs --export, --detach or --drop")
+
+    from .database import get_engine
+    engine = get_engine()
+
+    if args.command == "list":
+        with engine.connect() as connection:
+            for partition in list_partitions(connection):
+                rows = connection.execute(text("SELECT count(*) FROM {}".format(partition.name))).scalar()
+                bounds = "default" if partition.start is None else "{} to {}".format(partition.start, partition.end)
+                print("{:<16} {:<26} {:>10} rows".format(partition.name, bounds, rows))
+    elif args.command == "create":
+        with engine.begin() as connection:
+            for partition in ensure_partitions(connection, ahead=args.ahead):
+                print("created", partition.name)
+    else:
+        # Rows waiting in the default partition get theirs first, so they
+        # are archived with their period.
+        with engine.begin() as connection:
+            ensure_partitions(connection)
+        with engine.connect() as connection:
+            partitions = partitions_before(connection, args.before)
+        # One transaction per partition: the export is read in the same
+        # transaction that drops or detaches it.
+        for partition in partitions:
+            with engine.begin() as connection:
+                if args.export:
+                    path, rows = export_partition(connection, partition, args.export)
+                    print("exported {} rows of {} to {}".format(rows, partition.name, path))
+                if args.drop:
+                    drop_partition(connection, partition)
+                    print("dropped", partition.name)
+                elif args.detach:
+                    detach_partition(connection, partition)
+                    print("detached", partition.name)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+# Read replicas for the read-only routes.
+#
+# Sessions go round-robin to the replicas that passed their last health
+# check. A replica is taken out of rotation when it cannot be reached or
+# replays more than REPLICA_MAX_LAG_SECONDS behind the primary, and goes
+# back in once a later check passes. With no healthy replica, reads use
+# the primary.
+import itertools
+import logging
+import os
+
+import anyio
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+
+from . import database
+
+logger = logging.getLogger(__name__)
+
+REPLICA_DATABASE_URLS = [url.strip() for url in os.getenv("REPLICA_DATABASE_URLS", "").split(",") if url.strip()]
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", 5))
+REPLICA_CHECK_INTERVAL_SECONDS = float(os.getenv("REPLICA_CHECK_INTERVAL_SECONDS", 5))
+
+# Zero on a primary, and on a replica that has replayed all it received:
+# pg_last_xact_replay_timestamp() stays put while nothing is written.
+REPLICATION_LAG = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+
+
+class Replica:
+    def __init__(self, name: str, url: str):
+        self.name = name
+        self.url = url
+        self.async_url = url.replace("postgresql://", "postgresql+asyncpg://", 1)
+        self.healthy = True
+        self.lag = None
+        self._engine = None
+        self._async_engine = None
+        self._async_sessionmaker = None
+        self._session_factory = sessionmaker(autocommit=False, autoflush=False)
+
+    def engine(self):
+        if self._engine is None:
+            self._engine = create_engine(
+                self.url,
+                connect_args=database._connect_args(),
+                **database._engine_options(database.InstrumentedQueuePool)
+            )
+        return self._engine
+
+    def session(self):
+        return self._session_factory(bind=self.engine())
+
+    def async_session(self):
+        if self._async_sessionmaker is None:
+            from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+            self._async_engine = create_async_engine(
+                self.async_url,
+                connect_args=database._async_connect_args(),
+                **database._engine_options(database.InstrumentedAsyncQueuePool)
+            )
+            self._async_sessionmaker = sessionmaker(
+                self._async_engine,
+                class_=AsyncSession,
+                autocommit=False,
+                autoflush=False,
+                expire_on_commit=False
+            )
+        return self._async_sessionmaker()
+
+    def check(self, max_lag: float):
+        # A throwaway connection, so a check neither waits for nor holds a
+        # pooled one.
+        engine = create_engine(self.url, poolclass=NullPool)
+        try:
+            with engine.connect() as connection:
+                lag = float(connection.execute(REPLICATION_LAG).scalar())
+        except SQLAlchemyError as e:
+            self.mark_down("unreachable: {}".format(e.__class__.__name__))
+            return
+        finally:
+            engine.dispose()
+        self.lag = lag
+        if lag > max_lag:
+            self.mark_down("{:.1f}s behind".format(lag))
+        elif not self.healthy:
+            logger.info("Replica %s is back", self.name)
+            self.healthy = True
+
+    def mark_down(self, reason: str):
+        if self.healthy:
+            logger.warning("Replica %s taken out of rotation: %s", self.name, reason)
+        self.healthy = False
+
+    def forget_engines(self):
+        if self._engine is not None:
+            self._engine.dispose(close=False)
+        if self._async_engine is not None:
+            self._async_engine.sync_engine.dispose(close=False)
+        self._engine = self._async_engine = self._async_sessionmaker = None
+
+    def pool_stats(self):
+        stats = {}
+        if self._engine is not None:
+            stats[self.name] = database.pool_stats(self._engine.pool)
+        if self._async_engine is not None:
+            stats[self.name + "_async"] = database.pool_stats(self._async_engine.sync_engine.pool)
+        return stats
+
+
+class ReplicaSet:
+    def __init__(self, urls: list, max_lag: float = REPLICA_MAX_LAG_SECONDS):
+        self.replicas = [Replica("replica_{}".format(i), url) for i, url in enumerate(urls)]
+        self.max_lag = max_lag
+        self._turn = itertools.count()
+
+    def __bool__(self):
+        return bool(self.replicas)
+
+    def choose(self):
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        return healthy[next(self._turn) % len(healthy)]
+
+    def check(self):
+        for replica in self.replicas:
+            replica.check(self.max_lag)
+
+    async def watch(self, interval: float = REPLICA_CHECK_INTERVAL_SECONDS):
+        while True:
+            await anyio.to_thread.run_sync(self.check)
+            await anyio.sleep(interval)
+
+    def forget_engines(self):
+        for replica in self.replicas:
+            replica.forget_engines()
+
+    def pool_stats(self):
+        stats = {}
+        for replica in self.replicas:
+            stats.update(replica.pool_stats())
+        return stats
+
+
+replicas = ReplicaSet(REPLICA_DATABASE_URLS)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=replicas.forget_engines)
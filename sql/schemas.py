@@ -1,5 +1,4 @@
 from datetime import date, datetime, time
-from lib2to3.pytree import Base
 from typing import List, Union
 from pydantic import BaseModel
 
@@ -19,6 +18,10 @@ class User(UserBase):
 class Token(BaseModel):
     access_token: str 
     token_type: str 
+    refresh_token: Union[str, None] = None
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
 
 class TokenData(BaseModel):
     username: Union[str, None] = None
@@ -0,0 +1,32 @@
+import asyncio
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from .. import async_crud, schemas
+from .conftest import SQLALCHEMY_DATABASE_URL
+
+ASYNC_SQLALCHEMY_DATABASE_URL = SQLALCHEMY_DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
+
+
+def test_async_crud_with_sync_session(db):
+    users = asyncio.run(async_crud.get_users(db))
+    assert [u.user_name for u in users] == ["dummy_user"]
+
+def test_async_crud_with_async_session(db_engine):
+    pytest.importorskip("asyncpg")
+
+    async def run():
+        engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL)
+        async with engine.connect() as connection:
+            transaction = await connection.begin()
+            db = AsyncSession(bind=connection, expire_on_commit=False)
+
+            project = await async_crud.create_project(db, schemas.ProjectCreate(name="Async Project"))
+            assert (await async_crud.get_project(db, project.id)).name == "Async Project"
+            assert len(await async_crud.get_projects(db)) == 2
+
+            await transaction.rollback()
+        await engine.dispose()
+
+    asyncio.run(run())
@@ -0,0 +1,35 @@
+from ..catalog import ProjectCatalog
+from .. import models
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_catalog_loads_once_until_invalidated(db):
+    catalog = ProjectCatalog(ttl=60)
+    first = catalog.snapshot(db)
+    assert [p["name"] for p in first.projects] == ["Dummy Project"]
+    assert catalog.name(1) == "Dummy Project"
+
+    db.add(models.Project(name="Second"))
+    db.flush()
+    assert catalog.snapshot(db) is first
+
+    catalog.invalidate()
+    second = catalog.snapshot(db)
+    assert [p["name"] for p in second.projects] == ["Dummy Project", "Second"]
+    assert second.etag != first.etag
+
+def test_catalog_expires_after_ttl(db):
+    timer = FakeTimer()
+    catalog = ProjectCatalog(ttl=10, timer=timer)
+    first = catalog.snapshot(db)
+
+    timer.now = 10
+    assert catalog.name(1) is None
+    assert catalog.snapshot(db) is not first